@@ -0,0 +1,245 @@
+"""Storage backends for the shopping bag.
+
+The bag views, the `bag_contents` context processor and checkout all
+read and change the bag through the backend set by `BAG_BACKEND` in
+settings, via `get_bag_backend(request)`:
+
+- `DatabaseBagBackend` stores the bag in the `Cart`/`CartItem` tables.
+  Each change is a single row update, quantities are incremented in the
+  database, and the session is only written when the cart is created, so
+  two tabs changing the bag at once don't lose each other's updates.
+- `SessionBagBackend` keeps the original JSON bag in `request.session`,
+  for compatibility.
+
+Either way, `get_bag()` returns the bag in the original session format:
+`{item_id: quantity}` for products without sizes and
+`{item_id: {"items_by_size": {size: quantity}}}` for those with sizes.
+If a cart holds a product both with and without a size, e.g. after the
+product's sizes changed, the quantity without one is listed under the
+size `""`.
+
+Carts left behind by expired or logged out sessions are removed by the
+`delete_stale_carts` management command.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from products.models import Product
+
+from .models import Cart, CartItem
+
+
+class BaseBagBackend:
+    """Interface for bag storage. `size` is `None` for products without
+    sizes throughout.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def get_bag(self):
+        """Return the bag in the session format described above."""
+        raise NotImplementedError
+
+    def add(self, item_id, quantity, size=None):
+        """Add `quantity` of an item and return its new quantity.
+
+        Raises:
+            Product.DoesNotExist -- if the product doesn't exist
+        """
+        raise NotImplementedError
+
+    def set(self, item_id, quantity, size=None):
+        """Set the quantity of an item, removing it if `quantity` is 0."""
+        raise NotImplementedError
+
+    def remove(self, item_id, size=None):
+        """Remove an item in the given size, or in every size if `size`
+        is `None`.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Empty the bag."""
+        raise NotImplementedError
+
+
+class SessionBagBackend(BaseBagBackend):
+    """The original bag, stored as JSON in `request.session["bag"]`."""
+
+    def get_bag(self):
+        return self.request.session.get("bag", {})
+
+    def _save(self, bag):
+        self.request.session["bag"] = bag
+
+    def add(self, item_id, quantity, size=None):
+        item_id = str(item_id)
+        bag = self.get_bag()
+        if size:
+            item = bag.setdefault(item_id, {"items_by_size": {}})
+            sizes = item["items_by_size"]
+            sizes[size] = sizes.get(size, 0) + quantity
+            new_quantity = sizes[size]
+        else:
+            bag[item_id] = bag.get(item_id, 0) + quantity
+            new_quantity = bag[item_id]
+        self._save(bag)
+        return new_quantity
+
+    def set(self, item_id, quantity, size=None):
+        if quantity <= 0:
+            self.remove(item_id, size)
+            return
+        item_id = str(item_id)
+        bag = self.get_bag()
+        if size:
+            item = bag.setdefault(item_id, {"items_by_size": {}})
+            item["items_by_size"][size] = quantity
+        else:
+            bag[item_id] = quantity
+        self._save(bag)
+
+    def remove(self, item_id, size=None):
+        item_id = str(item_id)
+        bag = self.get_bag()
+        if size and isinstance(bag.get(item_id), dict):
+            bag[item_id]["items_by_size"].pop(size, None)
+            # If items by size dict is empty, remove the item
+            if not bag[item_id]["items_by_size"]:
+                bag.pop(item_id)
+        else:
+            bag.pop(item_id, None)
+        self._save(bag)
+
+    def clear(self):
+        self.request.session.pop("bag", None)
+
+
+class DatabaseBagBackend(BaseBagBackend):
+    """A bag stored in the `Cart` and `CartItem` tables.
+
+    The session holds only `cart_id`. It's carried over when the session
+    key changes on login, and dropped with the rest of the session on
+    logout.
+    """
+
+    SESSION_KEY = "cart_id"
+
+    @property
+    def cart_id(self):
+        return self.request.session.get(self.SESSION_KEY)
+
+    def _get_or_create_cart_id(self):
+        """Return the id of the session's cart, creating a new cart if
+        there's none or it has been deleted, e.g. by `delete_stale_carts`.
+
+        This costs a query, so it's only used before inserting items.
+        """
+        if (
+            self.cart_id is None
+            or not Cart.objects.filter(pk=self.cart_id).exists()
+        ):
+            self.request.session[self.SESSION_KEY] = Cart.objects.create().pk
+        return self.cart_id
+
+    def _items(self, item_id, size):
+        return CartItem.objects.filter(
+            cart_id=self.cart_id, product_id=item_id, size=size or ""
+        )
+
+    def get_bag(self):
+        bag = {}
+        if self.cart_id is None:
+            return bag
+        items = CartItem.objects.filter(cart_id=self.cart_id).order_by("pk")
+        for product_id, size, quantity in items.values_list(
+            "product_id", "size", "quantity"
+        ):
+            item_id = str(product_id)
+            item = bag.get(item_id)
+            if not size and item is None:
+                bag[item_id] = quantity
+                continue
+            if not isinstance(item, dict):
+                # Sized and unsized rows for the same product: keep both,
+                # with the unsized quantity under the size ""
+                sizes = {} if item is None else {"": item}
+                item = bag[item_id] = {"items_by_size": sizes}
+            item["items_by_size"][size] = quantity
+        return bag
+
+    def _check_product(self, item_id):
+        # Foreign keys are only checked on commit, so check up front
+        # rather than rely on an `IntegrityError`
+        if not Product.objects.filter(pk=item_id).exists():
+            raise Product.DoesNotExist(f"Product {item_id} does not exist")
+
+    def add(self, item_id, quantity, size=None):
+        # Increment in the database so concurrent adds are never lost
+        if self.cart_id is not None:
+            items = self._items(item_id, size)
+            if items.update(quantity=F("quantity") + quantity):
+                return items.values_list("quantity", flat=True).first()
+
+        self._check_product(item_id)
+        cart_id = self._get_or_create_cart_id()
+        try:
+            with transaction.atomic():
+                CartItem.objects.create(
+                    cart_id=cart_id,
+                    product_id=item_id,
+                    size=size or "",
+                    quantity=quantity,
+                )
+            return quantity
+        except IntegrityError:
+            # Another request created the row first; add to it
+            items = self._items(item_id, size)
+            items.update(quantity=F("quantity") + quantity)
+            return items.values_list("quantity", flat=True).first()
+
+    def set(self, item_id, quantity, size=None):
+        if quantity <= 0:
+            self.remove(item_id, size)
+            return
+        if self.cart_id is not None and self._items(item_id, size).update(
+            quantity=quantity
+        ):
+            return
+        self._check_product(item_id)
+        CartItem.objects.update_or_create(
+            cart_id=self._get_or_create_cart_id(),
+            product_id=item_id,
+            size=size or "",
+            defaults={"quantity": quantity},
+        )
+
+    def remove(self, item_id, size=None):
+        if self.cart_id is None:
+            return
+        if size:
+            self._items(item_id, size).delete()
+        else:
+            CartItem.objects.filter(
+                cart_id=self.cart_id, product_id=item_id
+            ).delete()
+
+    def clear(self):
+        if self.cart_id is not None:
+            Cart.objects.filter(pk=self.cart_id).delete()
+            del self.request.session[self.SESSION_KEY]
+
+
+def get_bag_backend(request):
+    """Return the configured bag backend for this request.
+
+    The backend is created once per request and reused.
+    """
+    if not hasattr(request, "_bag_backend"):
+        backend_class = import_string(settings.BAG_BACKEND)
+        request._bag_backend = backend_class(request)
+    return request._bag_backend
@@ -1,75 +1,113 @@
-from decimal import Decimal
+from functools import partial
 
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from django.utils.functional import SimpleLazyObject, cached_property
 
 from products.models import Product
 
+from .backends import get_bag_backend
+from .pricing import calculate_totals
 
-def bag_contents(request):
-    """A context processor for the contents of the shopping bag."""
-
-    # Init vars
-    bag_items = []
-    total = 0
-    product_count = 0
-    # Get bag or init. Origin: `add_to_bag` in views.py
-    bag = request.session.get("bag", {})
-
-    # Iterate through k:v items in the shopping bag to display on site
-    # This is the session bag
-    for item_id, item_data in bag.items():
-        # REFACTOR: `quantity` renamed to `item_data` as it may be dict
-        # If it just contains the quantity number:
-        if isinstance(item_data, int):
-            # Get the product first for calculations and information
-            product = get_object_or_404(Product, pk=item_id)
-            # Total is the quantity of each product's price
-            total += product.price * item_data
-            # Increment the product count by the quantity
-            product_count += item_data
-            # Add dict to list of bag items for access in templates
-            # This is like a context dict for the contents of the bag
-            bag_items.append(
-                {
-                    "item_id": item_id,
-                    "quantity": item_data,
-                    "product": product,
-                }
-            )
-        # Otherwise loop through inner dict and increment accordingly
-        else:
-            product = get_object_or_404(Product, pk=item_id)
-
-            for size, quantity in item_data["items_by_size"].items():
-                total += quantity * product.price
-                product_count += quantity
+
+class BagContents:
+    """The contents and totals of a shopping bag, computed on first use.
+
+    All products in the bag are loaded with a single query.
+    """
+
+    def __init__(self, bag):
+        """
+        Arguments:
+            bag -- the session bag dict, `{item_id: quantity}` or
+                `{item_id: {"items_by_size": {size: quantity}}}`
+        """
+        self.bag = bag
+
+    def __getitem__(self, key):
+        return self.context[key]
+
+    @cached_property
+    def context(self):
+        # Init vars
+        bag_items = []
+        # `(price, quantity)` pairs for working out the totals
+        lines = []
+        product_count = 0
+        # One query for every product in the bag, as a `{pk: product}` dict
+        products = Product.objects.in_bulk(list(self.bag.keys()))
+
+        # Iterate through k:v items in the shopping bag to display on site
+        # This is the session bag
+        for item_id, item_data in self.bag.items():
+            # Skip products that have been removed from the store
+            product = products.get(int(item_id))
+            if product is None:
+                continue
+
+            # REFACTOR: `quantity` renamed to `item_data` as it may be dict
+            # If it just contains the quantity number:
+            if isinstance(item_data, int):
+                # Total is the quantity of each product's price
+                lines.append((product.price, item_data))
+                # Increment the product count by the quantity
+                product_count += item_data
+                # Add dict to list of bag items for access in templates
+                # This is like a context dict for the contents of the bag
                 bag_items.append(
                     {
                         "item_id": item_id,
-                        "quantity": quantity,
+                        "quantity": item_data,
                         "product": product,
-                        "size": size,
                     }
                 )
+            # Otherwise loop through inner dict and increment accordingly
+            else:
+                for size, quantity in item_data["items_by_size"].items():
+                    lines.append((product.price, quantity))
+                    product_count += quantity
+                    bag_items.append(
+                        {
+                            "item_id": item_id,
+                            "quantity": quantity,
+                            "product": product,
+                            "size": size,
+                        }
+                    )
+
+        # Incentivize customers to meet free shipping threshold, via the
+        # `free_delivery_delta`
+        totals = calculate_totals(lines)
+
+        return {
+            "bag_items": bag_items,
+            "total": totals.subtotal,
+            "product_count": product_count,
+            "delivery": totals.delivery,
+            "free_delivery_delta": totals.free_delivery_delta,
+            "free_delivery_threshold": settings.FREE_DELIVERY_THRESHOLD,
+            "grand_total": totals.grand_total,
+        }
+
+
+def bag_contents(request):
+    """A context processor for the contents of the shopping bag.
 
-    # Incentivize customers to meet free shipping threshold
-    if total < settings.FREE_DELIVERY_THRESHOLD:
-        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
-        free_delivery_delta = settings.FREE_DELIVERY_THRESHOLD - total
-    else:
-        delivery = 0
-        free_delivery_delta = 0
-
-    grand_total = delivery + total
-
-    context = {
-        "bag_items": bag_items,
-        "total": total,
-        "product_count": product_count,
-        "delivery": delivery,
-        "free_delivery_delta": free_delivery_delta,
-        "free_delivery_threshold": settings.FREE_DELIVERY_THRESHOLD,
-        "grand_total": grand_total,
+    This runs for every template rendered with a request, so nothing is
+    computed up front. Each value is a callable, which the template
+    engine calls when a template first reads it, e.g. `{{ grand_total }}`.
+    Pages that never show the bag never query for the bag or its products.
+    """
+    bag = SimpleLazyObject(get_bag_backend(request).get_bag)
+    contents = BagContents(bag)
+    return {
+        key: partial(contents.__getitem__, key)
+        for key in (
+            "bag_items",
+            "total",
+            "product_count",
+            "delivery",
+            "free_delivery_delta",
+            "free_delivery_threshold",
+            "grand_total",
+        )
     }
-    return context
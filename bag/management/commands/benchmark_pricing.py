@@ -0,0 +1,57 @@
+"""Time `bag.pricing.calculate_totals` on large bags.
+
+    python manage.py benchmark_pricing
+    python manage.py benchmark_pricing --lines 100 10000 --repeat 10
+
+Lines are random prices and quantities, generated with a fixed seed so
+runs are comparable. No database access is needed.
+"""
+
+import random
+import timeit
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from bag.pricing import calculate_totals
+
+
+class Command(BaseCommand):
+    help = "Benchmark pricing bags of various sizes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lines",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000, 10000],
+            help="Bag sizes to time, in lines.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Timing runs per bag size; the fastest is reported.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed for the random prices and quantities.",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        for size in options["lines"]:
+            lines = [
+                (Decimal(rng.randint(100, 99999)) / 100, rng.randint(1, 99))
+                for _ in range(size)
+            ]
+            timer = timeit.Timer(lambda: calculate_totals(lines))
+            # Enough calls per run to take at least 0.2s
+            number, _ = timer.autorange()
+            best = min(timer.repeat(options["repeat"], number)) / number
+            self.stdout.write(
+                f"{size:>7} lines: {best * 1e6:10.1f} us per bag "
+                f"({size / best:,.0f} lines/s)"
+            )
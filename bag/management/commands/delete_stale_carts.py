@@ -0,0 +1,91 @@
+"""Delete carts that no live session refers to.
+
+    python manage.py delete_stale_carts
+    python manage.py delete_stale_carts --min-age 48 --dry-run
+
+`DatabaseBagBackend` keeps only the cart's id in the session, so a cart
+is left behind whenever its session expires or is flushed on logout.
+Run this regularly, e.g. daily after `clearsessions`, to remove them.
+
+Only carts older than `--min-age` hours are considered, so a cart
+created by a request whose session hasn't been saved yet is kept. It
+needs a database-backed `SESSION_ENGINE`, as the live sessions are read
+to find the carts still in use.
+"""
+
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from bag.backends import DatabaseBagBackend
+from bag.models import Cart
+
+
+class Command(BaseCommand):
+    help = "Delete carts that no live session refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=float,
+            default=24.0,
+            help="Hours a cart must have existed before it's deleted.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Carts deleted per query.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Count the stale carts without deleting them.",
+        )
+
+    def live_cart_ids(self):
+        """Return the ids of the carts referred to by unexpired
+        sessions.
+        """
+        store_class = import_module(settings.SESSION_ENGINE).SessionStore
+        if not hasattr(store_class, "get_model_class"):
+            raise CommandError(
+                "delete_stale_carts needs a database-backed SESSION_ENGINE"
+            )
+        store = store_class()
+        sessions = (
+            store_class.get_model_class()
+            .objects.filter(expire_date__gt=timezone.now())
+            .values_list("session_data", flat=True)
+        )
+        cart_ids = set()
+        for session_data in sessions.iterator():
+            cart_id = store.decode(session_data).get(
+                DatabaseBagBackend.SESSION_KEY
+            )
+            if cart_id is not None:
+                cart_ids.add(cart_id)
+        return cart_ids
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["min_age"])
+        live = self.live_cart_ids()
+        stale = [
+            pk
+            for pk in Cart.objects.filter(created__lt=cutoff)
+            .values_list("pk", flat=True)
+            .iterator()
+            if pk not in live
+        ]
+
+        if not options["dry_run"]:
+            size = options["batch_size"]
+            for start in range(0, len(stale), size):
+                Cart.objects.filter(
+                    pk__in=stale[start : start + size]
+                ).delete()
+        verb = "Found" if options["dry_run"] else "Deleted"
+        self.stdout.write(f"{verb} {len(stale)} stale carts")
@@ -1,3 +1,40 @@
 from django.db import models
 
-# Create your models here.
+from products.models import Product
+
+
+class Cart(models.Model):
+    """A shopping bag stored in the database.
+
+    The session only holds the cart's id, so changing the bag never
+    rewrites the session. See `DatabaseBagBackend` in `backends.py`.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Cart {self.pk}"
+
+
+class CartItem(models.Model):
+    """A quantity of one product, in one size, in a cart."""
+
+    cart = models.ForeignKey(
+        Cart, on_delete=models.CASCADE, related_name="items"
+    )
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # Empty for products without sizes
+    size = models.CharField(max_length=2, blank=True, default="")
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # One row per product and size, so quantities can be incremented
+        # in place
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cart", "product", "size"], name="unique_cart_item"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product} in {self.cart}"
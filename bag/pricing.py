@@ -0,0 +1,72 @@
+"""Prices for bags and orders.
+
+The bag, the checkout PaymentIntent and `Order` totals all work out
+delivery and grand totals here, so they always agree to the cent. The
+arithmetic is done in `Decimal` throughout; the delivery percentage from
+settings is converted via `str` so it never goes through a float.
+"""
+
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+
+CENT = Decimal("0.01")
+
+Totals = namedtuple(
+    "Totals",
+    ["subtotal", "delivery", "grand_total", "free_delivery_delta"],
+)
+
+
+def to_cents(amount):
+    """Round an amount to a whole number of cents."""
+    return Decimal(amount).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def to_stripe_amount(amount):
+    """Return an amount as an integer in the currency's smallest unit,
+    as Stripe expects, e.g. `Decimal("12.34")` becomes `1234`.
+    """
+    return int(to_cents(amount) * 100)
+
+
+def totals_for_subtotal(subtotal):
+    """Work out the delivery cost and grand total for a subtotal.
+
+    Delivery is a percentage of the subtotal, free at or above the free
+    delivery threshold.
+
+    Returns:
+        a `Totals` named tuple of `Decimal`s rounded to cents
+    """
+    subtotal = to_cents(subtotal)
+    threshold = Decimal(str(settings.FREE_DELIVERY_THRESHOLD))
+    if subtotal < threshold:
+        percentage = Decimal(str(settings.STANDARD_DELIVERY_PERCENTAGE))
+        delivery = to_cents(subtotal * percentage / 100)
+        free_delivery_delta = threshold - subtotal
+    else:
+        delivery = free_delivery_delta = Decimal("0.00")
+    return Totals(
+        subtotal=subtotal,
+        delivery=delivery,
+        grand_total=subtotal + delivery,
+        free_delivery_delta=to_cents(free_delivery_delta),
+    )
+
+
+def calculate_totals(lines):
+    """Price a batch of lines in one pass.
+
+    Arguments:
+        lines -- an iterable of `(price, quantity)` pairs, where `price`
+            is a `Decimal`
+
+    Returns:
+        a `Totals` named tuple of `Decimal`s rounded to cents
+    """
+    subtotal = Decimal(0)
+    for price, quantity in lines:
+        subtotal += price * quantity
+    return totals_for_subtotal(subtotal)
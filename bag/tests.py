@@ -1,3 +1,447 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import call_command
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.urls import reverse
+from django.utils import timezone
+
+from products.models import Product
+
+from .backends import DatabaseBagBackend, SessionBagBackend
+from .contexts import BagContents, bag_contents
+from .models import Cart, CartItem
+from .pricing import (
+    calculate_totals,
+    to_cents,
+    to_stripe_amount,
+    totals_for_subtotal,
+)
+
+
+def create_products(count, **kwargs):
+    return [
+        Product.objects.create(
+            name=f"Test shirt {n}",
+            description="A shirt",
+            price=Decimal("10.00"),
+            **kwargs,
+        )
+        for n in range(count)
+    ]
+
+
+class BagContentsTests(TestCase):
+    def test_products_are_loaded_with_one_query(self):
+        products = create_products(5)
+        bag = {str(product.pk): 2 for product in products[:3]}
+        bag[str(products[3].pk)] = {"items_by_size": {"s": 1, "m": 2}}
+        bag[str(products[4].pk)] = {"items_by_size": {"l": 1}}
+
+        with self.assertNumQueries(1):
+            contents = BagContents(bag)
+            self.assertEqual(len(contents["bag_items"]), 6)
+            self.assertEqual(contents["product_count"], 10)
+            self.assertEqual(contents["total"], Decimal("100.00"))
+
+    def test_removed_products_are_skipped(self):
+        product = create_products(1)[0]
+        bag = {str(product.pk): 1, "999999": 3}
+
+        with self.assertNumQueries(1):
+            contents = BagContents(bag)
+            self.assertEqual(len(contents["bag_items"]), 1)
+            self.assertEqual(contents["product_count"], 1)
+
+    def test_context_processor_queries_nothing_until_read(self):
+        request = RequestFactory().get("/")
+        request.session = {}
+
+        with self.assertNumQueries(0):
+            context = bag_contents(request)
+        # An empty bag needs no product query either
+        with self.assertNumQueries(0):
+            self.assertEqual(context["bag_items"](), [])
+
+
+class BagBackendTests:
+    """Tests run against each bag backend, mixed into a `TestCase` that
+    sets `backend_class`.
+    """
+
+    backend_class = None
+
+    def setUp(self):
+        self.product, self.sized = create_products(2)
+        self.backend = self.new_backend()
+
+    def new_backend(self, session=None):
+        request = RequestFactory().get("/")
+        request.session = SessionStore() if session is None else session
+        return self.backend_class(request)
+
+    def test_add_returns_the_new_quantity(self):
+        self.assertEqual(self.backend.add(self.product.pk, 2), 2)
+        self.assertEqual(self.backend.add(self.product.pk, 3), 5)
+        self.assertEqual(self.backend.add(self.sized.pk, 1, "m"), 1)
+        self.assertEqual(self.backend.add(self.sized.pk, 2, "l"), 2)
+
+        self.assertEqual(
+            self.backend.get_bag(),
+            {
+                str(self.product.pk): 5,
+                str(self.sized.pk): {"items_by_size": {"m": 1, "l": 2}},
+            },
+        )
+
+    def test_set_replaces_the_quantity(self):
+        self.backend.add(self.product.pk, 2)
+        self.backend.set(self.product.pk, 7)
+        self.backend.set(self.sized.pk, 3, "s")
+
+        self.assertEqual(
+            self.backend.get_bag(),
+            {
+                str(self.product.pk): 7,
+                str(self.sized.pk): {"items_by_size": {"s": 3}},
+            },
+        )
+
+    def test_set_to_zero_removes_the_item(self):
+        self.backend.add(self.product.pk, 2)
+        self.backend.set(self.product.pk, 0)
+        self.assertEqual(self.backend.get_bag(), {})
+
+    def test_remove_one_size_or_every_size(self):
+        self.backend.add(self.sized.pk, 1, "s")
+        self.backend.add(self.sized.pk, 1, "m")
+
+        self.backend.remove(self.sized.pk, "s")
+        self.assertEqual(
+            self.backend.get_bag(),
+            {str(self.sized.pk): {"items_by_size": {"m": 1}}},
+        )
+        self.backend.remove(self.sized.pk)
+        self.assertEqual(self.backend.get_bag(), {})
+
+    def test_clear_empties_the_bag(self):
+        self.backend.add(self.product.pk, 1)
+        self.backend.add(self.sized.pk, 1, "m")
+        self.backend.clear()
+        self.assertEqual(self.backend.get_bag(), {})
+
+    def test_empty_bag(self):
+        self.assertEqual(self.backend.get_bag(), {})
+        self.backend.remove(self.product.pk)
+        self.backend.clear()
+        self.assertEqual(self.backend.get_bag(), {})
+
+
+class SessionBagBackendTests(BagBackendTests, TestCase):
+    backend_class = SessionBagBackend
+
+    def test_bag_is_kept_in_the_session(self):
+        self.backend.add(self.product.pk, 2)
+        self.assertEqual(
+            self.backend.request.session["bag"], {str(self.product.pk): 2}
+        )
+
+
+class DatabaseBagBackendTests(BagBackendTests, TestCase):
+    backend_class = DatabaseBagBackend
+
+    def test_changes_do_not_write_the_session(self):
+        self.backend.add(self.product.pk, 1)
+        session = self.backend.request.session
+        session.modified = False
+
+        self.backend.add(self.product.pk, 1)
+        self.backend.set(self.product.pk, 5)
+        self.backend.remove(self.product.pk)
+        self.assertFalse(session.modified)
+
+    def test_stale_cart_is_replaced(self):
+        self.backend.add(self.product.pk, 2)
+        stale_id = self.backend.cart_id
+        Cart.objects.filter(pk=stale_id).delete()
+
+        self.assertEqual(self.backend.get_bag(), {})
+        self.assertEqual(self.backend.add(self.product.pk, 3), 3)
+        self.assertNotEqual(self.backend.cart_id, stale_id)
+        self.assertEqual(self.backend.get_bag(), {str(self.product.pk): 3})
+
+        Cart.objects.filter(pk=self.backend.cart_id).delete()
+        self.backend.set(self.sized.pk, 2, "m")
+        self.assertEqual(
+            self.backend.get_bag(),
+            {str(self.sized.pk): {"items_by_size": {"m": 2}}},
+        )
+
+    def test_missing_product_is_not_added(self):
+        with self.assertRaises(Product.DoesNotExist):
+            self.backend.add(999999, 1)
+        with self.assertRaises(Product.DoesNotExist):
+            self.backend.set(999999, 1)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_sized_and_unsized_rows_are_merged(self):
+        self.backend.add(self.sized.pk, 2)
+        self.backend.add(self.sized.pk, 1, "m")
+
+        self.assertEqual(
+            self.backend.get_bag(),
+            {str(self.sized.pk): {"items_by_size": {"": 2, "m": 1}}},
+        )
+        contents = BagContents(self.backend.get_bag())
+        self.assertEqual(contents["product_count"], 3)
+
+
+class DeleteStaleCartsTests(TestCase):
+    def setUp(self):
+        self.product = create_products(1)[0]
+
+    def create_cart(self, hours_old, session_saved=True):
+        session = SessionStore()
+        request = RequestFactory().get("/")
+        request.session = session
+        backend = DatabaseBagBackend(request)
+        backend.add(self.product.pk, 1)
+        if session_saved:
+            session.save()
+        Cart.objects.filter(pk=backend.cart_id).update(
+            created=timezone.now() - timedelta(hours=hours_old)
+        )
+        return backend.cart_id
+
+    def delete_stale_carts(self, *args):
+        stdout = StringIO()
+        call_command("delete_stale_carts", *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_only_old_carts_without_a_session_are_deleted(self):
+        live = self.create_cart(hours_old=48)
+        orphaned = self.create_cart(hours_old=48, session_saved=False)
+        recent = self.create_cart(hours_old=1, session_saved=False)
+
+        self.assertIn("Deleted 1 stale carts", self.delete_stale_carts())
+        self.assertEqual(
+            set(Cart.objects.values_list("pk", flat=True)), {live, recent}
+        )
+        self.assertFalse(CartItem.objects.filter(cart_id=orphaned).exists())
+
+    def test_dry_run_deletes_nothing(self):
+        self.create_cart(hours_old=48, session_saved=False)
+
+        self.assertIn(
+            "Found 1 stale carts", self.delete_stale_carts("--dry-run")
+        )
+        self.assertEqual(Cart.objects.count(), 1)
+
+
+class BagApiTests(TestCase):
+    def setUp(self):
+        self.product, self.sized = create_products(2)
+
+    def post(self, body, client=None, **extra):
+        client = client or self.client
+        return client.post(
+            reverse("bag_api"),
+            body if isinstance(body, str) else json.dumps(body),
+            content_type="application/json",
+            **extra,
+        )
+
+    def mutate(self, *mutations):
+        response = self.post({"mutations": list(mutations)})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_add_returns_the_changed_lines_and_totals(self):
+        data = self.mutate(
+            {"action": "add", "item_id": self.product.pk, "quantity": 2},
+            {
+                "action": "add",
+                "item_id": self.sized.pk,
+                "quantity": 1,
+                "product_size": "m",
+            },
+        )
+
+        self.assertEqual(
+            data["lines"],
+            [
+                {
+                    "item_id": str(self.product.pk),
+                    "product_size": None,
+                    "quantity": 2,
+                    "subtotal": "20.00",
+                },
+                {
+                    "item_id": str(self.sized.pk),
+                    "product_size": "m",
+                    "quantity": 1,
+                    "subtotal": "10.00",
+                },
+            ],
+        )
+        self.assertEqual(data["totals"]["product_count"], 3)
+        self.assertEqual(data["totals"]["total"], "30.00")
+
+    def test_adjust_sets_the_quantity(self):
+        self.mutate(
+            {"action": "add", "item_id": self.product.pk, "quantity": 2}
+        )
+        data = self.mutate(
+            {"action": "adjust", "item_id": self.product.pk, "quantity": 5}
+        )
+
+        self.assertEqual(data["lines"][0]["quantity"], 5)
+        self.assertEqual(data["lines"][0]["subtotal"], "50.00")
+        self.assertEqual(data["totals"]["product_count"], 5)
+
+    def test_remove_reports_a_quantity_of_zero(self):
+        self.mutate(
+            {"action": "add", "item_id": self.product.pk, "quantity": 2},
+            {"action": "add", "item_id": self.sized.pk, "quantity": 1},
+        )
+        data = self.mutate({"action": "remove", "item_id": self.product.pk})
+
+        self.assertEqual(data["lines"][0]["quantity"], 0)
+        self.assertEqual(data["lines"][0]["subtotal"], "0.00")
+        self.assertEqual(data["totals"]["product_count"], 1)
+
+    def test_invalid_input_is_rejected(self):
+        for body in (
+            "not json",
+            {"mutations": []},
+            {"mutations": [{"action": "buy", "item_id": self.product.pk}]},
+            {"mutations": [{"action": "add", "item_id": "x"}]},
+            {"mutations": [{"action": "add", "item_id": self.product.pk}]},
+            {
+                "mutations": [
+                    {
+                        "action": "adjust",
+                        "item_id": self.product.pk,
+                        "quantity": -1,
+                    }
+                ]
+            },
+        ):
+            with self.subTest(body=body):
+                response = self.post(body)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+    def test_nothing_is_applied_if_a_product_is_missing(self):
+        response = self.post(
+            {
+                "mutations": [
+                    {
+                        "action": "add",
+                        "item_id": self.product.pk,
+                        "quantity": 1,
+                    },
+                    {"action": "add", "item_id": 999999, "quantity": 1},
+                ]
+            }
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("999999", response.json()["error"])
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_only_post_is_allowed(self):
+        self.assertEqual(self.client.get(reverse("bag_api")).status_code, 405)
+
+    def test_csrf_token_is_required(self):
+        client = Client(enforce_csrf_checks=True)
+        body = {
+            "mutations": [
+                {"action": "add", "item_id": self.product.pk, "quantity": 1}
+            ]
+        }
+        self.assertEqual(self.post(body, client).status_code, 403)
+
+        # The bag page sets the cookie, and sends the token in a header
+        client.get(reverse("view_bag"))
+        token = client.cookies["csrftoken"].value
+        response = self.post(body, client, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(FREE_DELIVERY_THRESHOLD=50, STANDARD_DELIVERY_PERCENTAGE=10)
+class PricingTests(SimpleTestCase):
+    def test_delivery_is_charged_below_the_threshold(self):
+        totals = totals_for_subtotal(Decimal("49.99"))
+
+        self.assertEqual(totals.subtotal, Decimal("49.99"))
+        self.assertEqual(totals.delivery, Decimal("5.00"))
+        self.assertEqual(totals.grand_total, Decimal("54.99"))
+        self.assertEqual(totals.free_delivery_delta, Decimal("0.01"))
+
+    def test_delivery_is_free_at_the_threshold(self):
+        for subtotal in ("50.00", "120.00"):
+            with self.subTest(subtotal=subtotal):
+                totals = totals_for_subtotal(Decimal(subtotal))
+                self.assertEqual(totals.delivery, Decimal("0.00"))
+                self.assertEqual(totals.grand_total, Decimal(subtotal))
+                self.assertEqual(totals.free_delivery_delta, Decimal("0.00"))
+
+    @override_settings(STANDARD_DELIVERY_PERCENTAGE=7.5)
+    def test_fractional_percentage_is_not_a_float(self):
+        # 7.5% of 10.10 is 0.7575; via a float it would be 0.75749...
+        totals = totals_for_subtotal(Decimal("10.10"))
+        self.assertEqual(totals.delivery, Decimal("0.76"))
+
+    def test_amounts_are_rounded_half_up_to_cents(self):
+        self.assertEqual(to_cents(Decimal("0.005")), Decimal("0.01"))
+        self.assertEqual(to_cents(Decimal("0.0049")), Decimal("0.00"))
+        self.assertEqual(to_cents(Decimal("2.675")), Decimal("2.68"))
+        self.assertEqual(to_cents(3), Decimal("3.00"))
+
+    def test_delivery_is_rounded_to_cents(self):
+        # 10% of 0.15 is 0.015
+        totals = totals_for_subtotal(Decimal("0.15"))
+        self.assertEqual(totals.delivery, Decimal("0.02"))
+        self.assertEqual(totals.grand_total, Decimal("0.17"))
+
+    def test_stripe_amount_is_in_cents(self):
+        self.assertEqual(to_stripe_amount(Decimal("12.34")), 1234)
+        self.assertEqual(to_stripe_amount(Decimal("0.005")), 1)
+        self.assertEqual(to_stripe_amount(Decimal("19.999")), 2000)
+        self.assertEqual(to_stripe_amount(Decimal("0")), 0)
+        self.assertIsInstance(to_stripe_amount(Decimal("1.10")), int)
+
+    def test_calculate_totals_sums_the_lines(self):
+        totals = calculate_totals(
+            [(Decimal("19.99"), 2), (Decimal("0.33"), 3)]
+        )
+
+        self.assertEqual(totals.subtotal, Decimal("40.97"))
+        self.assertEqual(totals.delivery, Decimal("4.10"))
+        self.assertEqual(totals.grand_total, Decimal("45.07"))
+        self.assertEqual(calculate_totals([]).grand_total, Decimal("0.00"))
+
+
+class BagPageTests(TestCase):
+    def test_bag_page_has_hooks_for_the_bag_script(self):
+        product = create_products(1, image="test-shirt.jpg")[0]
+        self.client.post(
+            reverse("add_to_bag", args=[product.pk]),
+            {"quantity": 2, "redirect_url": "/"},
+        )
+
+        response = self.client.get(reverse("view_bag"))
+
+        # The main and mobile header totals
+        self.assertContains(response, "my-0 bag-nav-total", count=2)
+        self.assertContains(response, 'id="bag-error"')
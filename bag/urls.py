@@ -6,4 +6,5 @@ urlpatterns = [
     path("add/<item_id>/", views.add_to_bag, name="add_to_bag"),
     path("adjust/<item_id>/", views.adjust_bag, name="adjust_bag"),
     path("remove/<item_id>/", views.remove_from_bag, name="remove_from_bag"),
+    path("api/", views.bag_api, name="bag_api"),
 ]
@@ -130,6 +130,10 @@
 #     except Exception as e:
 #         return HttpResponse(status=500)
 
+import json
+
+from django.db import transaction
+from django.http import JsonResponse
 from django.shortcuts import (
     render,
     redirect,
@@ -138,9 +142,13 @@ from django.shortcuts import (
     get_object_or_404,
 )
 from django.contrib import messages
+from django.views.decorators.http import require_POST
 
 from products.models import Product
 
+from .backends import get_bag_backend
+from .contexts import BagContents
+
 # Create your views here.
 
 
@@ -159,39 +167,28 @@ def add_to_bag(request, item_id):
     size = None
     if "product_size" in request.POST:
         size = request.POST["product_size"]
-    bag = request.session.get("bag", {})
+
+    new_quantity = get_bag_backend(request).add(item_id, quantity, size)
 
     if size:
-        if item_id in list(bag.keys()):
-            if size in bag[item_id]["items_by_size"].keys():
-                bag[item_id]["items_by_size"][size] += quantity
-                messages.success(
-                    request,
-                    f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}',
-                )
-            else:
-                bag[item_id]["items_by_size"][size] = quantity
-                messages.success(
-                    request,
-                    f"Added size {size.upper()} {product.name} to your bag",
-                )
+        if new_quantity > quantity:
+            messages.success(
+                request,
+                f"Updated size {size.upper()} {product.name} quantity to {new_quantity}",
+            )
         else:
-            bag[item_id] = {"items_by_size": {size: quantity}}
             messages.success(
                 request,
                 f"Added size {size.upper()} {product.name} to your bag",
             )
     else:
-        if item_id in list(bag.keys()):
-            bag[item_id] += quantity
+        if new_quantity > quantity:
             messages.success(
-                request, f"Updated {product.name} quantity to {bag[item_id]}"
+                request, f"Updated {product.name} quantity to {new_quantity}"
             )
         else:
-            bag[item_id] = quantity
             messages.success(request, f"Added {product.name} to your bag")
 
-    request.session["bag"] = bag
     return redirect(redirect_url)
 
 
@@ -203,34 +200,29 @@ def adjust_bag(request, item_id):
     size = None
     if "product_size" in request.POST:
         size = request.POST["product_size"]
-    bag = request.session.get("bag", {})
+
+    # A quantity of 0 removes the item
+    get_bag_backend(request).set(item_id, quantity, size)
 
     if size:
         if quantity > 0:
-            bag[item_id]["items_by_size"][size] = quantity
             messages.success(
                 request,
-                f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}',
+                f"Updated size {size.upper()} {product.name} quantity to {quantity}",
             )
         else:
-            del bag[item_id]["items_by_size"][size]
-            if not bag[item_id]["items_by_size"]:
-                bag.pop(item_id)
             messages.success(
                 request,
                 f"Removed size {size.upper()} {product.name} from your bag",
             )
     else:
         if quantity > 0:
-            bag[item_id] = quantity
             messages.success(
-                request, f"Updated {product.name} quantity to {bag[item_id]}"
+                request, f"Updated {product.name} quantity to {quantity}"
             )
         else:
-            bag.pop(item_id)
             messages.success(request, f"Removed {product.name} from your bag")
 
-    request.session["bag"] = bag
     return redirect(reverse("view_bag"))
 
 
@@ -242,23 +234,151 @@ def remove_from_bag(request, item_id):
         size = None
         if "product_size" in request.POST:
             size = request.POST["product_size"]
-        bag = request.session.get("bag", {})
+
+        get_bag_backend(request).remove(item_id, size)
 
         if size:
-            del bag[item_id]["items_by_size"][size]
-            if not bag[item_id]["items_by_size"]:
-                bag.pop(item_id)
             messages.success(
                 request,
                 f"Removed size {size.upper()} {product.name} from your bag",
             )
         else:
-            bag.pop(item_id)
             messages.success(request, f"Removed {product.name} from your bag")
 
-        request.session["bag"] = bag
         return HttpResponse(status=200)
 
     except Exception as e:
         messages.error(request, f"Error removing item: {e}")
         return HttpResponse(status=500)
+
+
+# Most mutations accepted in one `bag_api` request
+MAX_MUTATIONS = 50
+
+
+def _parse_mutations(request):
+    """Read and validate the mutations in a `bag_api` request body.
+
+    Raises:
+        ValueError -- with a message for the response if anything is wrong
+
+    Returns:
+        a list of `(action, item_id, quantity, size)` tuples
+    """
+    try:
+        mutations = json.loads(request.body)["mutations"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Expected a JSON object with a "mutations" list')
+    if not isinstance(mutations, list) or not mutations:
+        raise ValueError('"mutations" must be a non-empty list')
+    if len(mutations) > MAX_MUTATIONS:
+        raise ValueError(f"At most {MAX_MUTATIONS} mutations are allowed")
+
+    parsed = []
+    for mutation in mutations:
+        if not isinstance(mutation, dict):
+            raise ValueError("Each mutation must be an object")
+        action = mutation.get("action")
+        if action not in ("add", "adjust", "remove"):
+            raise ValueError(f"Unknown action: {action}")
+        try:
+            item_id = str(int(mutation.get("item_id")))
+            quantity = int(mutation.get("quantity", 0))
+        except (TypeError, ValueError):
+            raise ValueError("item_id and quantity must be integers")
+        if quantity < 0 or (action == "add" and quantity < 1):
+            raise ValueError(f"Invalid quantity for {action}: {quantity}")
+        size = mutation.get("product_size") or None
+        parsed.append((action, item_id, quantity, size))
+
+    # All the products must exist before anything is changed
+    item_ids = {item_id for _, item_id, _, _ in parsed}
+    found = set(
+        Product.objects.filter(pk__in=item_ids).values_list("pk", flat=True)
+    )
+    missing = sorted(item_ids - {str(pk) for pk in found}, key=int)
+    if missing:
+        raise ValueError(f"Products not found: {', '.join(missing)}")
+    return parsed
+
+
+def _money(amount):
+    """Format an amount the way the bag template shows it."""
+    return f"{amount:.2f}"
+
+
+@require_POST
+def bag_api(request):
+    """Apply a batch of bag changes and return only what changed.
+
+    The body is JSON, e.g.:
+
+        {"mutations": [
+            {"action": "add", "item_id": 1, "quantity": 2,
+             "product_size": "m"},
+            {"action": "adjust", "item_id": 2, "quantity": 3},
+            {"action": "remove", "item_id": 3}
+        ]}
+
+    `add` and `adjust` behave like the `add_to_bag` and `adjust_bag`
+    views, and `remove` without a `product_size` removes every size.
+    Either every mutation is applied or, if any is invalid, none are.
+
+    The response has a line for each changed item, with a quantity of 0
+    for removed ones, and the new bag totals:
+
+        {"lines": [{"item_id": "1", "product_size": "m", "quantity": 2,
+                    "subtotal": "39.98"}, ...],
+         "totals": {"total": "...", "delivery": "...", ...}}
+    """
+    try:
+        mutations = _parse_mutations(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    backend = get_bag_backend(request)
+    try:
+        with transaction.atomic():
+            for action, item_id, quantity, size in mutations:
+                if action == "add":
+                    backend.add(item_id, quantity, size)
+                elif action == "adjust":
+                    backend.set(item_id, quantity, size)
+                else:
+                    backend.remove(item_id, size)
+    except Product.DoesNotExist as e:
+        # Deleted since the mutations were checked
+        return JsonResponse({"error": str(e)}, status=400)
+
+    contents = BagContents(backend.get_bag())
+    bag_lines = {
+        (item["item_id"], item.get("size") or None): item
+        for item in contents["bag_items"]
+    }
+
+    lines = []
+    for key in dict.fromkeys((m[1], m[3]) for m in mutations):
+        item = bag_lines.get(key)
+        lines.append(
+            {
+                "item_id": key[0],
+                "product_size": key[1],
+                "quantity": item["quantity"] if item else 0,
+                "subtotal": _money(
+                    item["product"].price * item["quantity"] if item else 0
+                ),
+            }
+        )
+
+    return JsonResponse(
+        {
+            "lines": lines,
+            "totals": {
+                "product_count": contents["product_count"],
+                "total": _money(contents["total"]),
+                "delivery": _money(contents["delivery"]),
+                "free_delivery_delta": _money(contents["free_delivery_delta"]),
+                "grand_total": _money(contents["grand_total"]),
+            },
+        }
+    )
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from .models import Order, OrderLineItem, OutboundEmail, WebhookEvent
 
 
 class OrderLineItemAdminInline(admin.TabularInline):
@@ -52,5 +52,33 @@ class OrderAdmin(admin.ModelAdmin):
     ordering = ("-date",)
 
 
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "event_id",
+        "event_type",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "received_at",
+    )
+    list_filter = ("status", "event_type")
+    ordering = ("-received_at",)
+
+
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = (
+        "subject",
+        "to_email",
+        "status",
+        "attempts",
+        "created_at",
+        "sent_at",
+    )
+    list_filter = ("status",)
+    ordering = ("-created_at",)
+
+
 # Register your models here.
 admin.site.register(Order, OrderAdmin)
+admin.site.register(WebhookEvent, WebhookEventAdmin)
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
@@ -8,6 +8,9 @@ class CheckoutConfig(AppConfig):
     def ready(self):
         """Override the `ready()` method to import the signals module,
         to call `update_total` model method every time a a line item is
-        saved or deleted.
+        saved or deleted, and to set up the Stripe API client.
         """
         import checkout.signals
+        from checkout import stripe_client
+
+        stripe_client.configure()
@@ -0,0 +1,54 @@
+"""Caching for rendered order details.
+
+`checkout_success` and the profile's `order_history` both show an
+order's details, which don't change once the order is complete. The
+rendered fragment is cached, keyed on the order number and the catalog
+version (see `products.cache`), since each line shows its product's
+current name and price. So a cache hit costs no line item or product
+queries at all, and an edit to the catalog makes every cached fragment
+unreachable at once.
+
+`signals.py` drops an order's fragment whenever the order is saved or
+deleted, and `services.update_order_totals` does the same for the orders
+it recalculates, as `bulk_update` doesn't send `post_save`.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from products.cache import get_catalog_version
+
+ORDER_DETAIL_TEMPLATE = "checkout/includes/order_detail.html"
+
+
+def order_detail_cache_key(order_number):
+    return f"checkout:order_detail:v{get_catalog_version()}:{order_number}"
+
+
+def render_order_detail(order):
+    """Return the order's rendered details, from the cache if possible.
+
+    On a miss, the line items and their products are fetched with one
+    query each before rendering.
+
+    Arguments:
+        order -- the `Order` to render
+    """
+    key = order_detail_cache_key(order.order_number)
+    html = cache.get(key)
+    if html is None:
+        prefetch_related_objects([order], "lineitems__product")
+        html = render_to_string(ORDER_DETAIL_TEMPLATE, {"order": order})
+        cache.set(key, html, settings.ORDER_DETAIL_CACHE_TIMEOUT)
+    # Rendered by us, so safe to output as is
+    return mark_safe(html)
+
+
+def invalidate_order_detail(*order_numbers):
+    """Drop the cached details of the given orders."""
+    cache.delete_many(
+        [order_detail_cache_key(number) for number in order_numbers]
+    )
@@ -1,5 +1,7 @@
 from django import forms
 
+from profiles.widgets import CountrySelect, country_choices
+
 from .models import Order
 
 
@@ -19,6 +21,8 @@ class OrderForm(forms.ModelForm):
             "country",
             "county",
         )
+        # Cached country select, see `profiles/widgets.py`
+        widgets = {"country": CountrySelect}
 
     # Override default form setup
     def __init__(self, *args, **kwargs):
@@ -27,6 +31,9 @@ class OrderForm(forms.ModelForm):
         labels and set autofocus on first field
         """
         super().__init__(*args, **kwargs)
+        self.fields["country"].choices = country_choices(
+            Order._meta.get_field("country").blank_label
+        )
         placeholders = {
             "full_name": "Full Name",
             "email": "Email Address",
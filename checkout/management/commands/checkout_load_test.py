@@ -0,0 +1,270 @@
+"""Drive whole checkouts against a running site and report latencies.
+
+Run the Stripe stand-in and point the site at it, e.g.:
+
+    python manage.py stripe_standin --quiet
+    STRIPE_API_BASE=http://127.0.0.1:12111 python manage.py runserver
+
+then:
+
+    python manage.py checkout_load_test --orders 200 --concurrency 10
+
+Each order goes through the same requests a customer's browser makes:
+add to bag, load the checkout page, `cache_checkout_data`, confirm the
+payment (with the stand-in, standing in for Stripe.js), submit the
+checkout form, and the `payment_intent.succeeded` webhook. The harness
+signs and delivers the webhook itself with `STRIPE_WH_SECRET`, so that
+it's timed, and the stand-in should run without `--webhook-url`.
+
+The report has p50/p95/p99 latencies for each step and for whole
+orders, and orders per second.
+"""
+
+import json
+import math
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from checkout.stripe_standin import build_event, sign_payload
+from products.models import Product
+
+STEPS = [
+    "add_to_bag",
+    "checkout",
+    "cache_checkout_data",
+    "confirm",
+    "place_order",
+    "webhook",
+]
+
+CLIENT_SECRET_RE = re.compile(r'name="client_secret" value="([^"]+)"')
+
+# Details submitted with every order
+CUSTOMER = {
+    "full_name": "Load Test",
+    "email": "load.test@example.com",
+    "phone_number": "0123456789",
+    "country": "GB",
+    "postcode": "LS1 1AA",
+    "town_or_city": "Leeds",
+    "street_address1": "1 Test Street",
+    "street_address2": "",
+    "county": "West Yorkshire",
+}
+
+
+def percentile(values, p):
+    """Return the nearest-rank `p`th percentile of sorted `values`."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class CheckoutError(Exception):
+    """A step of the checkout didn't respond as expected."""
+
+
+class Command(BaseCommand):
+    help = "Load test the checkout flow against a Stripe stand-in."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--site-url",
+            default="http://127.0.0.1:8000",
+            help="Base URL of the running site.",
+        )
+        parser.add_argument(
+            "--stripe-url",
+            default=settings.STRIPE_API_BASE or "http://127.0.0.1:12111",
+            help="Base URL of the Stripe stand-in.",
+        )
+        parser.add_argument(
+            "--orders",
+            type=int,
+            default=100,
+            help="Number of orders to place.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=10,
+            help="Number of orders placed at the same time.",
+        )
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=20,
+            help="Number of products to choose from for the bags.",
+        )
+
+    def handle(self, *args, **options):
+        self.site_url = options["site_url"].rstrip("/")
+        self.stripe_url = options["stripe_url"].rstrip("/")
+        self.product_ids = list(
+            Product.objects.order_by("pk").values_list("pk", flat=True)[
+                : options["products"]
+            ]
+        )
+        if not self.product_ids:
+            raise CommandError("There are no products to order.")
+
+        timings = defaultdict(list)
+        errors = defaultdict(int)
+        started = time.monotonic()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            futures = [
+                executor.submit(self.place_order, n)
+                for n in range(options["orders"])
+            ]
+            for future in as_completed(futures):
+                try:
+                    for step, seconds in future.result().items():
+                        timings[step].append(seconds)
+                except Exception as e:
+                    errors[str(e)] += 1
+        elapsed = time.monotonic() - started
+
+        self.report(timings, errors, elapsed)
+
+    def place_order(self, n):
+        """Place one order in a new session, timing each step.
+
+        Returns:
+            a dict of seconds taken by each step, and the whole `order`
+        """
+        session = requests.Session()
+        timings = {}
+        product_id = self.product_ids[n % len(self.product_ids)]
+
+        def timed(step, method, url, expect, **kwargs):
+            step_started = time.monotonic()
+            response = session.request(
+                method, url, allow_redirects=False, timeout=60, **kwargs
+            )
+            timings[step] = time.monotonic() - step_started
+            if response.status_code != expect:
+                raise CheckoutError(
+                    f"{step}: expected {expect}, got {response.status_code}"
+                )
+            return response
+
+        order_started = time.monotonic()
+
+        # Untimed: sets the CSRF cookie, as viewing the product would
+        session.get(f"{self.site_url}/products/{product_id}", timeout=60)
+        csrf = {"csrfmiddlewaretoken": session.cookies.get("csrftoken", "")}
+
+        timed(
+            "add_to_bag",
+            "POST",
+            f"{self.site_url}/bag/add/{product_id}/",
+            302,
+            data={**csrf, "quantity": 1 + n % 3, "redirect_url": "/bag/"},
+        )
+
+        response = timed("checkout", "GET", f"{self.site_url}/checkout/", 200)
+        match = CLIENT_SECRET_RE.search(response.text)
+        if not match:
+            raise CheckoutError("checkout: no client secret in the page")
+        client_secret = match.group(1)
+        intent_id = client_secret.split("_secret")[0]
+
+        timed(
+            "cache_checkout_data",
+            "POST",
+            f"{self.site_url}/checkout/cache_checkout_data/",
+            200,
+            data={**csrf, "client_secret": client_secret, "save_info": ""},
+        )
+
+        response = timed(
+            "confirm",
+            "POST",
+            f"{self.stripe_url}/v1/payment_intents/{intent_id}/confirm",
+            200,
+            data=self.confirm_params(),
+        )
+        intent = response.json()
+
+        timed(
+            "place_order",
+            "POST",
+            f"{self.site_url}/checkout/",
+            302,
+            data={**csrf, **CUSTOMER, "client_secret": client_secret},
+        )
+
+        event = build_event(
+            "payment_intent.succeeded", intent, f"evt_load_{intent_id}"
+        )
+        payload = json.dumps(event)
+        timed(
+            "webhook",
+            "POST",
+            f"{self.site_url}/checkout/webhook/",
+            200,
+            data=payload,
+            headers={
+                "Content-Type": "application/json",
+                "Stripe-Signature": sign_payload(
+                    payload, settings.STRIPE_WH_SECRET
+                ),
+            },
+        )
+
+        timings["order"] = time.monotonic() - order_started
+        return timings
+
+    def confirm_params(self):
+        """Return the form params Stripe.js sends to confirm a payment."""
+        address = {
+            "line1": CUSTOMER["street_address1"],
+            "line2": CUSTOMER["street_address2"],
+            "city": CUSTOMER["town_or_city"],
+            "country": CUSTOMER["country"],
+            "state": CUSTOMER["county"],
+        }
+        params = {
+            "payment_method_data[billing_details][email]": CUSTOMER["email"],
+            "payment_method_data[billing_details][name]": CUSTOMER[
+                "full_name"
+            ],
+            "shipping[name]": CUSTOMER["full_name"],
+            "shipping[phone]": CUSTOMER["phone_number"],
+            "shipping[address][postal_code]": CUSTOMER["postcode"],
+        }
+        for field, value in address.items():
+            params[f"shipping[address][{field}]"] = value
+        return params
+
+    def report(self, timings, errors, elapsed):
+        """Write latency percentiles per step, errors and throughput."""
+        self.stdout.write(
+            f"{'step':<20} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} "
+            f"{'p99 ms':>9}"
+        )
+        for step in STEPS + ["order"]:
+            values = sorted(timings.get(step, []))
+            if not values:
+                continue
+            p50, p95, p99 = (
+                percentile(values, p) * 1000 for p in (50, 95, 99)
+            )
+            self.stdout.write(
+                f"{step:<20} {len(values):>6} {p50:>9.1f} {p95:>9.1f} "
+                f"{p99:>9.1f}"
+            )
+
+        for message, count in errors.items():
+            self.stderr.write(f"{count} x {message}")
+
+        placed = len(timings.get("order", []))
+        failed = sum(errors.values())
+        self.stdout.write(
+            f"Orders: {placed} placed, {failed} failed in {elapsed:.2f}s "
+            f"({placed / max(elapsed, 1e-6):.1f} orders/s)"
+        )
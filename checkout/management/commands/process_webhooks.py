@@ -0,0 +1,176 @@
+"""Process Stripe webhook events queued by `checkout.webhooks.webhook`.
+
+Run it as a separate worker process (see `Procfile`):
+
+    python manage.py process_webhooks
+
+or drain the queue once and exit, e.g. from a scheduler:
+
+    python manage.py process_webhooks --once
+
+Each event is claimed in a short transaction, by marking it as
+processing, and handled with no transaction open. The handler may call
+Stripe, so a slow API call never holds a row lock. Events left claimed
+by a worker that died are claimed again after `--claim-timeout`
+seconds.
+"""
+
+import json
+import time
+from datetime import timedelta
+
+import stripe
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from checkout.models import WebhookEvent
+from checkout.webhook_handler import StripeWebHookHandler
+
+
+class Command(BaseCommand):
+    help = "Process queued Stripe webhook events, retrying failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process the events that are due, then exit.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Maximum number of events to process per batch.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait when there are no events due.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=8,
+            help="Attempts before an event is marked as failed.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=5.0,
+            help="Seconds before the first retry; doubles each attempt.",
+        )
+        parser.add_argument(
+            "--claim-timeout",
+            type=float,
+            default=300.0,
+            help="Seconds before events claimed by another worker that "
+            "didn't finish are claimed again.",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        while True:
+            processed = self.process_batch()
+            if options["once"] and processed < options["batch_size"]:
+                break
+            if not processed:
+                time.sleep(options["poll_interval"])
+
+    def process_batch(self):
+        """Process up to one batch of due events, one at a time.
+
+        Returns:
+            the number of events processed
+        """
+        processed = 0
+        for _ in range(self.options["batch_size"]):
+            webhook_event = self.claim_event()
+            if webhook_event is None:
+                break
+            self.process_event(webhook_event)
+            processed += 1
+        return processed
+
+    def claim_event(self):
+        """Claim the next due event for this worker.
+
+        The event is locked only while it's marked as processing, so
+        several workers can share the queue without handling an event
+        twice. Each claim counts as an attempt.
+
+        Returns:
+            the claimed `WebhookEvent`, or `None` if none are due
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.options["claim_timeout"])
+        with transaction.atomic():
+            webhook_event = (
+                WebhookEvent.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(status=WebhookEvent.PENDING, next_attempt_at__lte=now)
+                    | Q(status=WebhookEvent.PROCESSING, claimed_at__lt=stale)
+                )
+                .order_by("next_attempt_at")
+                .first()
+            )
+            if webhook_event is None:
+                return None
+            webhook_event.status = WebhookEvent.PROCESSING
+            webhook_event.claimed_at = now
+            webhook_event.attempts += 1
+            webhook_event.save(
+                update_fields=["status", "claimed_at", "attempts"]
+            )
+        return webhook_event
+
+    def process_event(self, webhook_event):
+        """Run the webhook handler for a claimed event and record the
+        result, scheduling a retry if it failed.
+
+        The handler is safe to run again: the order is created in its
+        own transaction, and a retry finds it by `stripe_pid`.
+        """
+        try:
+            event = stripe.Event.construct_from(
+                json.loads(webhook_event.payload), stripe.api_key
+            )
+            response = StripeWebHookHandler().dispatch(event)
+            # The handler reports failures with 5xx responses
+            if response.status_code >= 400:
+                raise RuntimeError(response.content.decode("utf-8"))
+
+        except Exception as e:
+            webhook_event.last_error = str(e)
+            if webhook_event.attempts >= self.options["max_attempts"]:
+                webhook_event.status = WebhookEvent.FAILED
+                self.stderr.write(f"Failed: {webhook_event} ({e})")
+            else:
+                webhook_event.status = WebhookEvent.PENDING
+                delay = self.options["backoff"] * 2 ** (
+                    webhook_event.attempts - 1
+                )
+                webhook_event.next_attempt_at = timezone.now() + timedelta(
+                    seconds=delay
+                )
+                self.stderr.write(
+                    f"Retrying {webhook_event} in {delay:.0f}s ({e})"
+                )
+
+        else:
+            webhook_event.status = WebhookEvent.DONE
+            webhook_event.last_error = ""
+            webhook_event.processed_at = timezone.now()
+            self.stdout.write(f"Processed: {webhook_event}")
+
+        webhook_event.save(
+            update_fields=[
+                "status",
+                "next_attempt_at",
+                "last_error",
+                "processed_at",
+            ]
+        )
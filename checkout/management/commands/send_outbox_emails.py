@@ -0,0 +1,200 @@
+"""Send the emails queued in the `OutboundEmail` outbox.
+
+Run it as a separate worker process (see `Procfile`):
+
+    python manage.py send_outbox_emails
+
+or send what is due once and exit, e.g. from a scheduler:
+
+    python manage.py send_outbox_emails --once
+
+Each batch is sent over a single connection from `get_connection()`, so
+it works with whichever `EMAIL_BACKEND` is configured, including the
+console and locmem backends.
+
+A batch is claimed in a short transaction, by marking its emails as
+sending, and sent with no transaction open, so a slow mail server never
+holds row locks. Each email's result is then saved on its own, so a
+failure to save one can't cause the others to be sent again. Emails left
+claimed by a sender that died are claimed again after `--claim-timeout`
+seconds.
+"""
+
+import time
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from checkout.models import OutboundEmail
+
+
+class Command(BaseCommand):
+    help = "Send queued emails in batches, retrying failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send the emails that are due, then exit.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Maximum number of emails to send per connection.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5.0,
+            help="Seconds to wait when there are no emails due.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=5,
+            help="Attempts before an email is marked as failed.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=30.0,
+            help="Seconds before the first retry; doubles each attempt.",
+        )
+        parser.add_argument(
+            "--claim-timeout",
+            type=float,
+            default=600.0,
+            help="Seconds before emails claimed by another sender that "
+            "didn't finish are claimed again.",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        run_started = time.monotonic()
+        total_sent = total_failed = 0
+
+        while True:
+            started = time.monotonic()
+            sent, failed = self.send_batch()
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.report("Batch", sent, failed, started)
+            if options["once"] and sent + failed < options["batch_size"]:
+                self.report("Total", total_sent, total_failed, run_started)
+                break
+            if not (sent or failed):
+                time.sleep(options["poll_interval"])
+
+    def report(self, label, sent, failed, started):
+        """Write the counts and throughput since `started`."""
+        elapsed = time.monotonic() - started
+        rate = (sent + failed) / max(elapsed, 1e-6)
+        self.stdout.write(
+            f"{label}: sent {sent}, failed {failed} in {elapsed:.2f}s "
+            f"({rate:.1f} emails/s)"
+        )
+
+    def claim_batch(self):
+        """Claim up to one batch of due emails for this sender.
+
+        The emails are locked only while they are marked as sending, so
+        several senders can share the outbox without sending an email
+        twice. Each claim counts as an attempt.
+
+        Returns:
+            the claimed `OutboundEmail`s
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.options["claim_timeout"])
+        with transaction.atomic():
+            emails = list(
+                OutboundEmail.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(
+                        status=OutboundEmail.PENDING,
+                        next_attempt_at__lte=now,
+                    )
+                    | Q(status=OutboundEmail.SENDING, claimed_at__lt=stale)
+                )
+                .order_by("next_attempt_at")[: self.options["batch_size"]]
+            )
+            for email in emails:
+                email.status = OutboundEmail.SENDING
+                email.claimed_at = now
+                email.attempts += 1
+            OutboundEmail.objects.bulk_update(
+                emails, ["status", "claimed_at", "attempts"]
+            )
+        return emails
+
+    def send_batch(self):
+        """Claim and send up to one batch of due emails over one
+        connection.
+
+        Returns:
+            a `(sent, failed)` tuple of counts
+        """
+        sent = failed = 0
+        emails = self.claim_batch()
+        if not emails:
+            return sent, failed
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # Nothing can be sent; retry the whole batch later
+            for email in emails:
+                self.record_failure(email, e)
+            return sent, len(emails)
+
+        try:
+            for email in emails:
+                message = EmailMessage(
+                    email.subject,
+                    email.body,
+                    email.from_email,
+                    [email.to_email],
+                    connection=connection,
+                )
+                try:
+                    message.send()
+                except Exception as e:
+                    self.record_failure(email, e)
+                    failed += 1
+                else:
+                    self.record_success(email)
+                    sent += 1
+        finally:
+            connection.close()
+        return sent, failed
+
+    def record_success(self, email):
+        email.status = OutboundEmail.SENT
+        email.sent_at = timezone.now()
+        email.last_error = ""
+        email.save(update_fields=["status", "sent_at", "last_error"])
+
+    def record_failure(self, email, error):
+        """Schedule a retry for `email`, or mark it as failed when it is
+        out of attempts.
+
+        Arguments:
+            email -- the claimed `OutboundEmail` that couldn't be sent
+            error -- the exception raised
+        """
+        email.last_error = str(error)
+        if email.attempts >= self.options["max_attempts"]:
+            email.status = OutboundEmail.FAILED
+            self.stderr.write(f"Failed: {email} ({error})")
+        else:
+            email.status = OutboundEmail.PENDING
+            delay = self.options["backoff"] * 2 ** (email.attempts - 1)
+            email.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        email.save(update_fields=["status", "next_attempt_at", "last_error"])
@@ -0,0 +1,54 @@
+"""Run the local Stripe stand-in from `checkout/stripe_standin.py`.
+
+    python manage.py stripe_standin --port 12111 \
+        --webhook-url http://127.0.0.1:8000/checkout/webhook/
+
+then run the site with `STRIPE_API_BASE=http://127.0.0.1:12111`. Events
+are signed with `STRIPE_WH_SECRET`.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from checkout.stripe_standin import StandinServer
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the Stripe API."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=12111)
+        parser.add_argument(
+            "--webhook-url",
+            help="Where to deliver signed events when a payment succeeds.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Seconds to wait before each response.",
+        )
+        parser.add_argument(
+            "--quiet",
+            action="store_true",
+            help="Don't log each request.",
+        )
+
+    def handle(self, *args, **options):
+        server = StandinServer(
+            (options["host"], options["port"]),
+            webhook_url=options["webhook_url"],
+            webhook_secret=settings.STRIPE_WH_SECRET,
+            latency=options["latency"],
+            verbose=not options["quiet"],
+        )
+        self.stdout.write(f"Stripe stand-in listening on {server.url}")
+        if not settings.STRIPE_WH_SECRET and options["webhook_url"]:
+            self.stderr.write("STRIPE_WH_SECRET is empty; events won't verify")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
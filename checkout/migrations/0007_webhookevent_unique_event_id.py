@@ -0,0 +1,39 @@
+# Generated by Django 3.2.19 on 2026-10-18 10:09
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_events(apps, schema_editor):
+    """Keep one row per Stripe event id, preferring a processed one."""
+    WebhookEvent = apps.get_model("checkout", "WebhookEvent")
+    duplicate_ids = (
+        WebhookEvent.objects.values("event_id")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .values_list("event_id", flat=True)
+    )
+    for event_id in list(duplicate_ids):
+        events = list(WebhookEvent.objects.filter(event_id=event_id))
+        events.sort(key=lambda event: (event.status != "done", event.id))
+        WebhookEvent.objects.filter(
+            id__in=[event.id for event in events[1:]]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0006_webhookevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_events, migrations.RunPython.noop
+        ),
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='event_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2.19 on 2026-10-18 10:22
+
+import uuid
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def _duplicates(Order, field, **exclude):
+    """Return the values of `field` shared by more than one order."""
+    return list(
+        Order.objects.exclude(**exclude)
+        .values(field)
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .values_list(field, flat=True)
+    )
+
+
+def resolve_duplicates(apps, schema_editor):
+    """Make existing order numbers and payment intent ids unique.
+
+    Orders sharing an order number are given new random numbers, except
+    the first. Orders sharing a payment intent were created twice for one
+    payment: the first keeps the id, and the others get it with a
+    `_duplicate_<id>` suffix, so they can still be found and reviewed.
+    """
+    Order = apps.get_model("checkout", "Order")
+
+    for order_number in _duplicates(Order, "order_number"):
+        orders = Order.objects.filter(order_number=order_number)
+        for order in orders.order_by("id")[1:]:
+            order.order_number = uuid.uuid4().hex.upper()
+            order.save(update_fields=["order_number"])
+
+    for stripe_pid in _duplicates(Order, "stripe_pid", stripe_pid=""):
+        orders = Order.objects.filter(stripe_pid=stripe_pid)
+        for order in orders.order_by("id")[1:]:
+            order.stripe_pid = f"{stripe_pid}_duplicate_{order.id}"
+            order.save(update_fields=["stripe_pid"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0008_outboundemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_pid', ''), _negated=True), fields=('stripe_pid',), name='unique_order_stripe_pid'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.19 on 2026-10-18 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0009_order_unique_number_and_stripe_pid'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_profile', 'date'], name='order_profile_date_idx'),
+        ),
+    ]
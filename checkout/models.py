@@ -1,13 +1,16 @@
 # For unique order numbers
 import uuid
 
-from django.conf import settings
 from django.db import models
 from django.db.models import Sum
+from django.utils import timezone
 
 # For country dropdown box
 from django_countries.fields import CountryField
 
+# Delivery and grand totals, shared with the bag
+from bag.pricing import totals_for_subtotal
+
 # For use as FK
 from products.models import Product
 
@@ -20,7 +23,10 @@ class Order(models.Model):
     """Handles all orders across the store."""
 
     # Unique and permanent (not editable) value so users can find previous orders
-    order_number = models.CharField(max_length=32, null=False, editable=False)
+    # Unique, so looking an order up by its number is an index lookup
+    order_number = models.CharField(
+        max_length=32, null=False, editable=False, unique=True
+    )
     # NEW - for linking an order to a user profile
     # Set null to keep order history if user is deleted
     # Null and blank so users without an account can order
@@ -59,10 +65,32 @@ class Order(models.Model):
     # The original shopping bag that made the order
     original_bag = models.TextField(null=False, blank=False, default="")
     # Stripe payment intent id (guaranteed unique)
+    # Indexed as the webhook and checkout view look orders up by it, and
+    # unique when set (see `Meta`)
     stripe_pid = models.CharField(
-        max_length=254, null=False, blank=False, default=""
+        max_length=254, null=False, blank=False, default="", db_index=True
     )
 
+    class Meta:
+        constraints = [
+            # One order per payment, so the checkout view and the webhook
+            # can't both create one. Orders added without a payment intent
+            # (e.g. in the admin) have an empty `stripe_pid`
+            models.UniqueConstraint(
+                fields=["stripe_pid"],
+                condition=~models.Q(stripe_pid=""),
+                name="unique_order_stripe_pid",
+            )
+        ]
+        indexes = [
+            # A customer's order history, newest first, is read straight
+            # off this index (see `profiles.views.profile`)
+            models.Index(
+                fields=["user_profile", "date"],
+                name="order_profile_date_idx",
+            )
+        ]
+
     # Private syntax - only used within this class
     def _generate_order_number(self):
         """Generate random, unique, 32 char order number."""
@@ -82,21 +110,23 @@ class Order(models.Model):
         """
         # Prevent error by giving 'or 0' for when all line items are removed
         # manually by setting order total to 0 and not None
-        self.order_total = (
+        self.set_totals(
             self.lineitems.aggregate(Sum("lineitem_total"))[
                 "lineitem_total__sum"
             ]
             or 0
         )
-        if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
-            self.delivery_cost = (
-                self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
-            )
-        else:
-            self.delivery_cost = 0
-        self.grand_total = self.order_total + self.delivery_cost
         self.save()
 
+    def set_totals(self, order_total):
+        """Set the order total, delivery cost and grand total without
+        saving, for when the sum of the line items is already known.
+        """
+        totals = totals_for_subtotal(order_total)
+        self.order_total = totals.subtotal
+        self.delivery_cost = totals.delivery
+        self.grand_total = totals.grand_total
+
     # Default save method override
     def save(self, *args, **kwargs):
         """Override default save method to add uuid if not present."""
@@ -153,3 +183,94 @@ class OrderLineItem(models.Model):
 
     def __str__(self):
         return f"SKU {self.product.sku} on order {self.order.order_number}"
+
+
+class WebhookEvent(models.Model):
+    """A verified Stripe webhook event, stored so it can be acknowledged
+    straight away and processed later by the `process_webhooks`
+    management command.
+
+    Failed events are retried with exponential backoff until they
+    succeed or run out of attempts.
+    """
+
+    PENDING = "pending"
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    # Stripe event id, e.g. `evt_...`
+    # Unique, so this table is also a ledger of every event received and
+    # a redelivered event is recognised with one index lookup
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=255)
+    # The verified request body, as sent by Stripe
+    payload = models.TextField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    # When the worker should next try the event
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # When a worker last claimed the event for processing
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # The worker polls for pending events that are due
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
+
+
+class OutboundEmail(models.Model):
+    """An email waiting in the outbox to be sent by the
+    `send_outbox_emails` management command.
+
+    Writing emails here instead of sending them keeps SMTP out of the
+    request/webhook, and lets the sender deliver a whole batch over one
+    connection and retry failures.
+    """
+
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    )
+
+    subject = models.CharField(max_length=254)
+    body = models.TextField()
+    from_email = models.EmailField(max_length=254)
+    to_email = models.EmailField(max_length=254)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    # When the sender should next try the email
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # When a sender last claimed the email for sending
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # The sender polls for pending emails that are due
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to_email}"
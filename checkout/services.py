@@ -0,0 +1,230 @@
+"""Order creation shared by the checkout view and the Stripe webhook
+handler, loading orders to show their details, batched recalculation of
+order totals, and PaymentIntents reused across checkout page loads.
+
+Line items are inserted with `bulk_create`, which doesn't call
+`OrderLineItem.save()` or send the `post_save` signal that recalculates
+the order total. Instead the totals are worked out once from the bag,
+so creating an order costs the same few queries however big the bag is.
+"""
+
+import stripe
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.shortcuts import get_object_or_404
+
+from products.models import Product
+
+from . import stripe_client
+from .cache import invalidate_order_detail
+from .models import Order, OrderLineItem
+
+# Orders recalculated per query in `update_order_totals`
+TOTALS_BATCH_SIZE = 500
+
+# Session key for the PaymentIntent reused by `get_payment_intent`
+PAYMENT_INTENT_SESSION_KEY = "checkout_payment_intent"
+
+# Statuses of a PaymentIntent that can still be paid by the customer
+REUSABLE_INTENT_STATUSES = (
+    "requires_payment_method",
+    "requires_confirmation",
+    "requires_action",
+)
+
+
+def create_order(order, bag):
+    """Save an unsaved `order` with a line item for each item in `bag`.
+
+    Everything is saved in one transaction, so if anything fails there
+    is no half-created order left behind.
+
+    Arguments:
+        order -- an unsaved `Order` with the customer's details filled in
+        bag -- the shopping bag dict from the session or PaymentIntent
+
+    Raises:
+        Product.DoesNotExist -- a product in the bag isn't in the database
+
+    Returns:
+        the saved order
+    """
+    # One query for every product in the bag, as a `{pk: product}` dict
+    products = Product.objects.in_bulk(list(bag.keys()))
+
+    line_items = []
+    for item_id, item_data in bag.items():
+        product = products.get(int(item_id))
+        if product is None:
+            raise Product.DoesNotExist(f"Product {item_id} does not exist")
+
+        # For items without sizes, a single line item with no size
+        if isinstance(item_data, int):
+            quantities = {None: item_data}
+        else:
+            quantities = item_data["items_by_size"]
+
+        for size, quantity in quantities.items():
+            line_items.append(
+                OrderLineItem(
+                    product=product,
+                    product_size=size,
+                    quantity=quantity,
+                    # Set here as `bulk_create` skips the custom `save()`
+                    lineitem_total=product.price * quantity,
+                )
+            )
+
+    with transaction.atomic():
+        order.set_totals(sum(item.lineitem_total for item in line_items))
+        order.save()
+        for line_item in line_items:
+            line_item.order = order
+        OrderLineItem.objects.bulk_create(line_items)
+
+    return order
+
+
+def get_or_create_order(order, bag):
+    """Return the order for `order.stripe_pid`, creating it from `order`
+    and `bag` if there isn't one yet.
+
+    The checkout view and the webhook both call this for the same
+    payment, possibly at the same time. `stripe_pid` is unique, so if both
+    try to create the order, one insert fails and that caller gets the
+    order the other one created.
+
+    Arguments:
+        order -- an unsaved `Order` with the customer's details and
+            `stripe_pid` filled in
+        bag -- the shopping bag dict from the session or PaymentIntent
+
+    Raises:
+        Product.DoesNotExist -- a product in the bag isn't in the database
+
+    Returns:
+        a `(order, created)` tuple
+    """
+    # Without a payment intent there is nothing to match on
+    if not order.stripe_pid:
+        return create_order(order, bag), True
+
+    existing = Order.objects.filter(stripe_pid=order.stripe_pid).first()
+    if existing:
+        return existing, False
+    try:
+        return create_order(order, bag), True
+    except IntegrityError:
+        # Created by the other caller since the lookup above; the failed
+        # insert was rolled back by `create_order`
+        existing = Order.objects.filter(stripe_pid=order.stripe_pid).first()
+        if existing is None:
+            raise
+        return existing, False
+
+
+def get_order_detail(order_number):
+    """Return the order to show on the checkout success and order history
+    pages, or raise `Http404`.
+
+    Its line items and their products are only needed to render the
+    details, so `cache.render_order_detail` prefetches them when the
+    rendered details aren't cached.
+    """
+    return get_object_or_404(
+        Order.objects.select_related("user_profile"),
+        order_number=order_number,
+    )
+
+
+def update_order_totals(order_ids):
+    """Recalculate the totals of many orders in a few queries.
+
+    For each batch of orders the line item totals are summed with one
+    grouped aggregate query, and the new totals are written back with one
+    `bulk_update`, instead of an aggregate and a save per order.
+
+    Arguments:
+        order_ids -- ids of the orders to update; missing ones are skipped
+    """
+    order_ids = sorted(set(order_ids))
+    for start in range(0, len(order_ids), TOTALS_BATCH_SIZE):
+        batch = order_ids[start : start + TOTALS_BATCH_SIZE]
+        line_totals = dict(
+            OrderLineItem.objects.filter(order_id__in=batch)
+            .values("order_id")
+            .annotate(total=Sum("lineitem_total"))
+            .values_list("order_id", "total")
+        )
+        orders = list(
+            Order.objects.filter(pk__in=batch).only(
+                "order_number", "order_total", "delivery_cost", "grand_total"
+            )
+        )
+        for order in orders:
+            # 0 for orders with all their line items removed
+            order.set_totals(line_totals.get(order.pk) or 0)
+        Order.objects.bulk_update(
+            orders, ["order_total", "delivery_cost", "grand_total"]
+        )
+        # `bulk_update` doesn't send `post_save`, so drop their cached
+        # details here
+        invalidate_order_detail(*(order.order_number for order in orders))
+
+
+def get_payment_intent(session, amount):
+    """Return the PaymentIntent to pay `amount` at checkout.
+
+    The intent is cached in the session, so reloading the checkout page
+    costs no Stripe call at all while the amount stays the same. The
+    cached intent is dropped once an order is placed with it, by the
+    checkout view or the webhook. When the amount changed, it's sent to
+    Stripe with `PaymentIntent.modify`. A new intent is created when
+    there is none, or the cached one can't be paid any more (e.g. it was
+    already paid or cancelled).
+
+    Arguments:
+        session -- the request's session
+        amount -- the grand total in the smallest currency unit
+
+    Raises:
+        StripeUnavailable -- Stripe can't be reached right now
+
+    Returns:
+        a dict of the intent's `id` and `client_secret`, along with the
+        `amount` it was last set for
+    """
+    cached = session.get(PAYMENT_INTENT_SESSION_KEY)
+    if cached and Order.objects.filter(stripe_pid=cached["id"]).exists():
+        # Paid for an order, e.g. one created by the webhook
+        del session[PAYMENT_INTENT_SESSION_KEY]
+        cached = None
+
+    if cached and cached["amount"] == amount:
+        return cached
+
+    intent = None
+    if cached:
+        try:
+            intent = stripe_client.call(
+                "PaymentIntent.modify", cached["id"], amount=amount
+            )
+        except stripe.error.InvalidRequestError:
+            # It can't be changed any more, so start again
+            pass
+    if intent is not None and intent.status not in REUSABLE_INTENT_STATUSES:
+        intent = None
+    if intent is None:
+        intent = stripe_client.call(
+            "PaymentIntent.create",
+            amount=amount,
+            currency=settings.STRIPE_CURRENCY,
+        )
+
+    session[PAYMENT_INTENT_SESSION_KEY] = {
+        "id": intent.id,
+        "client_secret": intent.client_secret,
+        "amount": amount,
+    }
+    return session[PAYMENT_INTENT_SESSION_KEY]
@@ -1,17 +1,70 @@
 """These signals are used to update the the order totals each time
-a line item is attached to the order.
+a line item is attached to the order, and to drop an order's cached
+details when it changes.
 
 The module's `apps.py` must be updated to know about these signals.
+
+Updates are coalesced: the orders touched are collected until the
+current transaction commits, then each order is recalculated once. So
+deleting a product with 10k line items across 2k orders, or saving
+several inlines in the admin, recalculates each order a single time.
+Outside a transaction the update runs straight away, as before.
 """
 
+import threading
+
+# Run the update once the transaction has been committed
+from django.db import connection, transaction
+
 # Send these signals after ('post') the action
 from django.db.models.signals import post_delete, post_save
 
 # To receive signals
 from django.dispatch import receiver
 
-# The model we are listening to signals from
-from .models import OrderLineItem
+from .cache import invalidate_order_detail
+
+# The models we are listening to signals from
+from .models import Order, OrderLineItem
+from .services import update_order_totals
+
+# Ids of orders waiting for their totals to be updated, per thread
+_pending = threading.local()
+
+
+def _update_pending_totals():
+    """Update every pending order, and clear them even if that fails, so
+    the next update registers a new callback.
+    """
+    try:
+        order_ids = getattr(_pending, "order_ids", None)
+        if order_ids:
+            update_order_totals(order_ids)
+    finally:
+        _pending.order_ids = set()
+
+
+def _callback_registered():
+    return any(
+        func is _update_pending_totals for _, func in connection.run_on_commit
+    )
+
+
+def schedule_total_update(order_id):
+    """Update the order's totals when the current transaction commits.
+
+    The callback is registered once, when the first order becomes
+    pending. It's registered again only if it was dropped along with a
+    rolled back savepoint or transaction, whose leftover ids are then
+    just recalculated too.
+    """
+    order_ids = getattr(_pending, "order_ids", None)
+    if order_ids is None:
+        order_ids = _pending.order_ids = set()
+    was_empty = not order_ids
+    order_ids.add(order_id)
+    if was_empty or not _callback_registered():
+        transaction.on_commit(_update_pending_totals)
 
 
 @receiver(post_save, sender=OrderLineItem)
@@ -28,7 +81,7 @@ def update_on_save(sender, instance, created, **kwargs):
         instance -- the instance of the model that sent the signal
         created -- determine if this is a new instance or update (bool)
     """
-    instance.order.update_total()
+    schedule_total_update(instance.order_id)
 
 
 @receiver(post_delete, sender=OrderLineItem)
@@ -39,4 +92,16 @@ def update_on_delete(sender, instance, **kwargs):
         sender -- the sender of the signal (OrderLineItem)
         instance -- the instance of the model that sent the signal
     """
-    instance.order.update_total()
+    schedule_total_update(instance.order_id)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def invalidate_detail(sender, instance, **kwargs):
+    """Drop the order's cached details when it's saved or deleted.
+
+    Arguments:
+        sender -- the sender of the signal (Order)
+        instance -- the instance of the model that sent the signal
+    """
+    invalidate_order_detail(instance.order_number)
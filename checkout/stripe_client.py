@@ -0,0 +1,286 @@
+"""The one place the site talks to the Stripe API.
+
+`configure()` is called once at startup (see `apps.py`) and sets up the
+`stripe` library with:
+
+- the API key, and the API base URL if `STRIPE_API_BASE` is set
+
+- a `requests` session, so connections to Stripe are pooled and reused
+  instead of opened for every call
+- connect and read timeouts, so a slow Stripe can't hold a gunicorn
+  worker for long (the library default is 80 seconds)
+- a bounded number of network retries, which the library only makes for
+  requests that are safe to retry
+
+API calls go through `call()`, e.g.
+`call("PaymentIntent.create", amount=1000, currency="usd")`. It times
+each call per API method (see `get_metrics()`), and feeds a circuit
+breaker: after `STRIPE_BREAKER_THRESHOLD` consecutive connection or
+server errors, calls fail straight away with `StripeUnavailable` for
+`STRIPE_BREAKER_RESET_TIMEOUT` seconds, then one call is let through to
+see if Stripe has recovered.
+
+Objects fetched with `retrieve()` are kept for
+`STRIPE_OBJECT_CACHE_TIMEOUT` seconds, so retries of the same webhook
+don't fetch them again.
+
+The breaker, the metrics and the object cache are per process.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import requests
+import stripe
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Shown to customers when Stripe can't be reached
+FRIENDLY_MESSAGE = (
+    "Sorry, our payment provider isn't responding right now. "
+    "Please try again in a few minutes."
+)
+
+# Errors that mean Stripe itself is unreachable or failing, as opposed to
+# errors about the request, like a declined card
+UNAVAILABLE_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.APIError,
+    stripe.error.RateLimitError,
+)
+
+
+class StripeUnavailable(Exception):
+    """Stripe is unreachable, or the circuit breaker is open."""
+
+    def __init__(self, message=FRIENDLY_MESSAGE):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """Fail fast after repeated failures, then retry after a pause.
+
+    Closed: calls go through, and consecutive failures are counted.
+    Open: once `threshold` failures in a row are reached, calls are
+    refused until `reset_timeout` seconds have passed.
+    Half-open: then one trial call goes through. If it succeeds the
+    breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may go ahead now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        "Stripe circuit breaker opened after %d failures",
+                        self.failures,
+                    )
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """End a call that neither succeeded nor failed, e.g. one
+        rejected by Stripe for a bad request.
+        """
+        with self._lock:
+            self.trial_running = False
+
+
+class Metrics:
+    """Call counts, errors and latencies per Stripe API method."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = defaultdict(
+                lambda: {
+                    "calls": 0,
+                    "errors": 0,
+                    "total_seconds": 0.0,
+                    "max_seconds": 0.0,
+                }
+            )
+
+    def record(self, method, seconds, error=False):
+        with self._lock:
+            stats = self._stats[method]
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        """Return a copy of the stats, with each method's mean latency."""
+        with self._lock:
+            return {
+                method: {
+                    **stats,
+                    "mean_seconds": stats["total_seconds"] / stats["calls"],
+                }
+                for method, stats in self._stats.items()
+            }
+
+
+class ObjectCache:
+    """A small in-memory cache of Stripe objects that expire after
+    `timeout` seconds, holding at most `max_size` of them.
+    """
+
+    def __init__(self, timeout, max_size=256):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, obj = self._objects.get(key, (0, None))
+            if expires > time.monotonic():
+                return obj
+            self._objects.pop(key, None)
+            return None
+
+    def set(self, key, obj):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._objects) >= self.max_size:
+                # Drop expired objects, then the oldest if still full
+                self._objects = {
+                    k: v for k, v in self._objects.items() if v[0] > now
+                }
+                if len(self._objects) >= self.max_size:
+                    del self._objects[next(iter(self._objects))]
+            self._objects[key] = (now + self.timeout, obj)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+
+breaker = CircuitBreaker(
+    settings.STRIPE_BREAKER_THRESHOLD, settings.STRIPE_BREAKER_RESET_TIMEOUT
+)
+metrics = Metrics()
+objects = ObjectCache(settings.STRIPE_OBJECT_CACHE_TIMEOUT)
+
+
+def configure():
+    """Set up the `stripe` library's key, HTTP client and retries."""
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    if settings.STRIPE_API_BASE:
+        stripe.api_base = settings.STRIPE_API_BASE
+    stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=settings.STRIPE_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    stripe.default_http_client = stripe.http_client.RequestsClient(
+        timeout=(
+            settings.STRIPE_CONNECT_TIMEOUT,
+            settings.STRIPE_READ_TIMEOUT,
+        ),
+        session=session,
+    )
+
+
+def call(method, *args, **kwargs):
+    """Call a Stripe API method through the circuit breaker, timing it.
+
+    Arguments:
+        method -- the method's path in the `stripe` library, e.g.
+            `"PaymentIntent.modify"`
+        args, kwargs -- passed on to the method
+
+    Raises:
+        StripeUnavailable -- Stripe can't be reached, or the breaker is open
+        stripe.error.StripeError -- any other error from Stripe
+
+    Returns:
+        whatever the method returns
+    """
+    if not breaker.allow():
+        metrics.record(method, 0.0, error=True)
+        raise StripeUnavailable()
+
+    # Looked up on each call, so a patched `stripe` attribute is used
+    resource_name, method_name = method.split(".")
+    function = getattr(getattr(stripe, resource_name), method_name)
+
+    started = time.monotonic()
+    try:
+        result = function(*args, **kwargs)
+    except UNAVAILABLE_ERRORS as e:
+        elapsed = time.monotonic() - started
+        metrics.record(method, elapsed, error=True)
+        breaker.record_failure()
+        logger.warning("Stripe %s failed after %.3fs: %s", method, elapsed, e)
+        raise StripeUnavailable() from e
+    except Exception:
+        metrics.record(method, time.monotonic() - started, error=True)
+        breaker.release()
+        raise
+
+    elapsed = time.monotonic() - started
+    metrics.record(method, elapsed)
+    breaker.record_success()
+    logger.debug("Stripe %s took %.3fs", method, elapsed)
+    return result
+
+
+def retrieve(resource_name, object_id, **kwargs):
+    """Retrieve a Stripe object by id through `call()`, reusing one
+    fetched in the last `STRIPE_OBJECT_CACHE_TIMEOUT` seconds.
+
+    Arguments:
+        resource_name -- the object's class in the `stripe` library, e.g.
+            `"Charge"`
+        object_id -- the object's id
+        kwargs -- passed on to `retrieve`, e.g. `expand`
+    """
+    key = (resource_name, object_id, repr(sorted(kwargs.items())))
+    obj = objects.get(key)
+    if obj is None:
+        obj = call(f"{resource_name}.retrieve", object_id, **kwargs)
+        objects.set(key, obj)
+    return obj
+
+
+def get_metrics():
+    """Return this process's Stripe call stats, keyed by API method."""
+    return metrics.snapshot()
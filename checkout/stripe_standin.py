@@ -0,0 +1,321 @@
+"""A local stand-in for the parts of the Stripe API the site uses.
+
+It serves the PaymentIntent and Charge endpoints over HTTP, so the
+`stripe` library talks to it unchanged when `STRIPE_API_BASE` points at
+it, and it signs webhook events with `STRIPE_WH_SECRET` the same way
+Stripe does. Run it with the `stripe_standin` management command, or
+start a `StandinServer` in-process, e.g. in tests.
+
+Supported endpoints:
+
+    POST /v1/payment_intents                  create
+    GET  /v1/payment_intents/<id>             retrieve
+    POST /v1/payment_intents/<id>             modify
+    POST /v1/payment_intents/<id>/confirm     confirm, as Stripe.js does
+    GET  /v1/charges/<id>                     retrieve
+
+Confirming an intent always succeeds: it creates a charge with the
+billing details sent, and if a webhook URL is set, delivers a signed
+`payment_intent.succeeded` event to it in the background.
+
+Everything is kept in memory, and authentication isn't checked.
+"""
+
+import hmac
+import itertools
+import json
+import re
+import threading
+import time
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+
+# Matches the API version the `stripe` library pins
+API_VERSION = "2022-11-15"
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Return a `Stripe-Signature` header value for a webhook payload.
+
+    Arguments:
+        payload -- the request body, as `str`
+        secret -- the webhook signing secret, `STRIPE_WH_SECRET`
+        timestamp -- Unix time to sign with; defaults to now
+    """
+    timestamp = int(timestamp or time.time())
+    signed = f"{timestamp}.{payload}".encode()
+    signature = hmac.new(secret.encode(), signed, sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def build_event(event_type, obj, event_id):
+    """Return a Stripe event dict wrapping `obj`."""
+    return {
+        "id": event_id,
+        "object": "event",
+        "api_version": API_VERSION,
+        "created": int(time.time()),
+        "type": event_type,
+        "livemode": False,
+        "data": {"object": obj},
+    }
+
+
+def deliver_event(url, event, secret):
+    """POST a signed event to a webhook URL.
+
+    Returns:
+        the response status code
+    """
+    payload = json.dumps(event)
+    request = Request(
+        url,
+        data=payload.encode(),
+        headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": sign_payload(payload, secret),
+        },
+    )
+    with urlopen(request, timeout=30) as response:
+        return response.status
+
+
+def parse_form(body):
+    """Decode a form-encoded Stripe request into nested dicts, e.g.
+    `shipping[address][city]=Leeds` into
+    `{"shipping": {"address": {"city": "Leeds"}}}`.
+    """
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r"[^\[\]]+", key)
+        target = params
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return params
+
+
+def full_address(address):
+    """Return an address with every field Stripe sends, `None` if blank."""
+    address = address or {}
+    return {
+        field: address.get(field) or None
+        for field in (
+            "city",
+            "country",
+            "line1",
+            "line2",
+            "postal_code",
+            "state",
+        )
+    }
+
+
+class StripeError(Exception):
+    """An error response in Stripe's format."""
+
+    def __init__(self, status, message, error_type="invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": {"type": error_type, "message": message}}
+
+
+class Stripe:
+    """The stand-in's in-memory objects and API operations."""
+
+    def __init__(self, webhook_url=None, webhook_secret=""):
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.payment_intents = {}
+        self.charges = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _new_id(self, prefix):
+        return f"{prefix}_standin{next(self._ids):08d}"
+
+    def _get(self, objects, object_id):
+        try:
+            return objects[object_id]
+        except KeyError:
+            raise StripeError(404, f"No such object: '{object_id}'")
+
+    def create_payment_intent(self, params):
+        try:
+            amount = int(params["amount"])
+        except (KeyError, ValueError):
+            raise StripeError(400, "Missing required param: amount.")
+        with self._lock:
+            intent_id = self._new_id("pi")
+            intent = {
+                "id": intent_id,
+                "object": "payment_intent",
+                "amount": amount,
+                "amount_received": 0,
+                "currency": params.get("currency", "usd"),
+                "client_secret": f"{intent_id}_secret_standin",
+                "created": int(time.time()),
+                "latest_charge": None,
+                "livemode": False,
+                "metadata": params.get("metadata", {}),
+                "receipt_email": None,
+                "shipping": None,
+                "status": "requires_payment_method",
+            }
+            self.payment_intents[intent_id] = intent
+        return intent
+
+    def modify_payment_intent(self, intent_id, params):
+        with self._lock:
+            intent = self._get(self.payment_intents, intent_id)
+            if "amount" in params:
+                if intent["status"] == "succeeded":
+                    raise StripeError(
+                        400,
+                        "This PaymentIntent's amount could not be updated "
+                        "because it has a status of succeeded.",
+                    )
+                intent["amount"] = int(params["amount"])
+            intent["metadata"].update(params.get("metadata", {}))
+        return intent
+
+    def confirm_payment_intent(self, intent_id, params):
+        with self._lock:
+            intent = self._get(self.payment_intents, intent_id)
+            if intent["status"] == "succeeded":
+                raise StripeError(
+                    400, "This PaymentIntent has already succeeded."
+                )
+            billing_details = params.get("payment_method_data", {}).get(
+                "billing_details", {}
+            )
+            charge_id = self._new_id("ch")
+            self.charges[charge_id] = {
+                "id": charge_id,
+                "object": "charge",
+                "amount": intent["amount"],
+                "billing_details": {
+                    "address": full_address(billing_details.get("address")),
+                    "email": billing_details.get("email"),
+                    "name": billing_details.get("name"),
+                    "phone": billing_details.get("phone"),
+                },
+                "currency": intent["currency"],
+                "paid": True,
+                "payment_intent": intent_id,
+                "status": "succeeded",
+            }
+            shipping = params.get("shipping")
+            if shipping:
+                shipping = {
+                    "address": full_address(shipping.get("address")),
+                    "name": shipping.get("name"),
+                    "phone": shipping.get("phone"),
+                }
+            intent.update(
+                status="succeeded",
+                amount_received=intent["amount"],
+                latest_charge=charge_id,
+                shipping=shipping,
+            )
+            event = build_event(
+                "payment_intent.succeeded",
+                json.loads(json.dumps(intent)),
+                self._new_id("evt"),
+            )
+        if self.webhook_url:
+            threading.Thread(
+                target=deliver_event,
+                args=(self.webhook_url, event, self.webhook_secret),
+                daemon=True,
+            ).start()
+        return intent
+
+    def route(self, method, path, params):
+        """Run the operation for a request and return its response."""
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["v1", "payment_intents"]:
+            if len(parts) == 2 and method == "POST":
+                return self.create_payment_intent(params)
+            if len(parts) == 3 and method == "GET":
+                return self._get(self.payment_intents, parts[2])
+            if len(parts) == 3 and method == "POST":
+                return self.modify_payment_intent(parts[2], params)
+            if len(parts) == 4 and parts[3] == "confirm":
+                return self.confirm_payment_intent(parts[2], params)
+        if parts[:2] == ["v1", "charges"] and len(parts) == 3:
+            return self._get(self.charges, parts[2])
+        raise StripeError(404, f"Unrecognized request URL ({method}: {path})")
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.respond("GET", url.path, parse_form(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode()
+        self.respond("POST", urlsplit(self.path).path, parse_form(body))
+
+    def respond(self, method, path, params):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            status, body = 200, self.server.stripe.route(method, path, params)
+        except StripeError as e:
+            status, body = e.status, e.body
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Request-Id", f"req_standin_{time.monotonic_ns()}")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class StandinServer(ThreadingHTTPServer):
+    """The stand-in HTTP server. Port 0 picks a free port.
+
+    Arguments:
+        address -- `(host, port)` to listen on
+        webhook_url -- where to deliver events, or `None` not to
+        webhook_secret -- the secret to sign events with
+        latency -- seconds to wait before each response, to simulate a
+            slow Stripe
+        verbose -- whether to log each request
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        webhook_url=None,
+        webhook_secret="",
+        latency=0.0,
+        verbose=False,
+    ):
+        super().__init__(address, StandinRequestHandler)
+        self.stripe = Stripe(webhook_url, webhook_secret)
+        self.latency = latency
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve in a background thread, e.g. for tests."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
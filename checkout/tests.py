@@ -1,3 +1,1020 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from products.models import Product
+from profiles.models import UserProfile
+
+from . import stripe_client
+from .models import Order, OrderLineItem, OutboundEmail, WebhookEvent
+from .services import (
+    PAYMENT_INTENT_SESSION_KEY,
+    create_order,
+    get_or_create_order,
+    get_payment_intent,
+    update_order_totals,
+)
+from .stripe_standin import StandinServer, build_event, sign_payload
+
+# The real class, as `stripe.PaymentIntent` is patched in the tests
+PaymentIntent = stripe.PaymentIntent
+
+
+class FakePaymentIntents:
+    """A local stand-in for `stripe.PaymentIntent`, recording each call.
+
+    Intents are kept in memory. Modifying one that has been paid or
+    cancelled raises the same error Stripe does.
+    """
+
+    def __init__(self):
+        self.intents = {}
+        self.calls = []
+
+    def create(self, amount, currency, **kwargs):
+        self.calls.append(("create", amount))
+        intent_id = f"pi_{len(self.intents) + 1}"
+        intent = PaymentIntent.construct_from(
+            {
+                "id": intent_id,
+                "client_secret": f"{intent_id}_secret_test",
+                "amount": amount,
+                "currency": currency,
+                "status": "requires_payment_method",
+            },
+            "sk_test",
+        )
+        self.intents[intent_id] = intent
+        return intent
+
+    def modify(self, intent_id, amount=None, **kwargs):
+        self.calls.append(("modify", amount))
+        intent = self.intents[intent_id]
+        if intent.status in ("succeeded", "canceled"):
+            raise stripe.error.InvalidRequestError(
+                "This PaymentIntent's amount could not be updated because "
+                f"it has a status of {intent.status}.",
+                "amount",
+            )
+        if amount is not None:
+            intent.amount = amount
+        return intent
+
+
+class GetPaymentIntentTests(TestCase):
+    def setUp(self):
+        self.stripe = FakePaymentIntents()
+        patcher = mock.patch(
+            "checkout.services.stripe.PaymentIntent", self.stripe
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = {}
+
+    def test_creates_an_intent_once(self):
+        first = get_payment_intent(self.session, 2000)
+        second = get_payment_intent(self.session, 2000)
+
+        self.assertEqual(self.stripe.calls, [("create", 2000)])
+        self.assertEqual(first["client_secret"], second["client_secret"])
+
+    def test_modifies_the_intent_when_the_amount_changes(self):
+        first = get_payment_intent(self.session, 2000)
+        second = get_payment_intent(self.session, 3000)
+
+        self.assertEqual(
+            self.stripe.calls, [("create", 2000), ("modify", 3000)]
+        )
+        self.assertEqual(first["id"], second["id"])
+        self.assertEqual(self.stripe.intents[first["id"]].amount, 3000)
+        self.assertEqual(self.session[PAYMENT_INTENT_SESSION_KEY], second)
+
+    def test_reuses_a_modified_intent_awaiting_the_customer(self):
+        first = get_payment_intent(self.session, 2000)
+        for amount, status in (
+            (3000, "requires_confirmation"),
+            (4000, "requires_action"),
+        ):
+            with self.subTest(status=status):
+                self.stripe.intents[first["id"]].status = status
+                intent = get_payment_intent(self.session, amount)
+                self.assertEqual(intent["id"], first["id"])
+
+    def test_creates_a_new_intent_when_the_old_one_was_paid(self):
+        first = get_payment_intent(self.session, 2000)
+        self.stripe.intents[first["id"]].status = "succeeded"
+
+        second = get_payment_intent(self.session, 3000)
+
+        self.assertEqual(
+            self.stripe.calls,
+            [("create", 2000), ("modify", 3000), ("create", 3000)],
+        )
+        self.assertNotEqual(first["id"], second["id"])
+
+    def test_changed_amount_does_not_reuse_a_finished_intent(self):
+        for status in ("succeeded", "canceled", "processing"):
+            with self.subTest(status=status):
+                first = get_payment_intent(self.session, 2000)
+                self.stripe.intents[first["id"]].status = status
+
+                second = get_payment_intent(self.session, 3000)
+
+                self.assertNotEqual(first["id"], second["id"])
+                self.assertEqual(
+                    self.session[PAYMENT_INTENT_SESSION_KEY], second
+                )
+
+    def test_intent_used_by_an_order_is_dropped(self):
+        first = get_payment_intent(self.session, 2000)
+        Order.objects.create(
+            full_name="A Customer",
+            email="customer@example.com",
+            phone_number="0123456789",
+            country="GB",
+            town_or_city="Leeds",
+            street_address1="1 Test Street",
+            stripe_pid=first["id"],
+        )
+
+        second = get_payment_intent(self.session, 2000)
+
+        # Stripe isn't asked about the used intent at all
+        self.assertEqual(
+            self.stripe.calls, [("create", 2000), ("create", 2000)]
+        )
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertEqual(self.session[PAYMENT_INTENT_SESSION_KEY], second)
+
+
+class CheckoutPaymentIntentTests(TestCase):
+    def setUp(self):
+        self.stripe = FakePaymentIntents()
+        patcher = mock.patch(
+            "checkout.services.stripe.PaymentIntent", self.stripe
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.product = Product.objects.create(
+            name="Test shirt",
+            description="A shirt",
+            price=Decimal("10.00"),
+            image="test-shirt.jpg",
+        )
+        self.add_to_bag(1)
+
+    def add_to_bag(self, quantity):
+        self.client.post(
+            reverse("add_to_bag", args=[self.product.pk]),
+            {"quantity": quantity, "redirect_url": "/"},
+        )
+
+    def test_reloading_checkout_reuses_the_intent(self):
+        first = self.client.get(reverse("checkout"))
+        second = self.client.get(reverse("checkout"))
+
+        self.assertEqual(self.stripe.calls, [("create", 1100)])
+        self.assertEqual(
+            first.context["client_secret"], second.context["client_secret"]
+        )
+
+    def test_changing_the_bag_modifies_the_intent(self):
+        first = self.client.get(reverse("checkout"))
+        self.add_to_bag(1)
+        second = self.client.get(reverse("checkout"))
+
+        self.assertEqual(
+            self.stripe.calls, [("create", 1100), ("modify", 2200)]
+        )
+        self.assertEqual(
+            first.context["client_secret"], second.context["client_secret"]
+        )
+
+    def test_form_is_prefilled_from_the_profile(self):
+        user = User.objects.create_user(
+            "customer", email="customer@example.com", password="password"
+        )
+        UserProfile.objects.filter(user=user).update(
+            default_town_or_city="Leeds"
+        )
+        self.client.force_login(user)
+        self.add_to_bag(1)
+
+        form = self.client.get(reverse("checkout")).context["order_form"]
+        self.assertEqual(form.initial["email"], "customer@example.com")
+        self.assertEqual(form.initial["town_or_city"], "Leeds")
+
+    def test_invalid_form_is_shown_with_its_errors(self):
+        first = self.client.get(reverse("checkout"))
+        fields = (
+            "full_name",
+            "email",
+            "phone_number",
+            "country",
+            "postcode",
+            "town_or_city",
+            "street_address1",
+            "street_address2",
+            "county",
+        )
+        data = dict.fromkeys(fields, "")
+        data["full_name"] = "A Customer"
+
+        response = self.client.post(reverse("checkout"), data)
+
+        self.assertEqual(response.status_code, 200)
+        form = response.context["order_form"]
+        self.assertTrue(form.is_bound)
+        self.assertEqual(form["full_name"].value(), "A Customer")
+        self.assertIn("email", form.errors)
+        self.assertEqual(
+            response.context["client_secret"], first.context["client_secret"]
+        )
+        self.assertFalse(Order.objects.exists())
+
+
+class StripeClientTests(TestCase):
+    def setUp(self):
+        self.breaker = stripe_client.CircuitBreaker(
+            threshold=2, reset_timeout=30
+        )
+        self.metrics = stripe_client.Metrics()
+        for name in ("breaker", "metrics"):
+            patcher = mock.patch.object(
+                stripe_client, name, getattr(self, name)
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.stripe = FakePaymentIntents()
+        self.stripe.create = mock.Mock(
+            side_effect=stripe.error.APIConnectionError("timed out")
+        )
+        patcher = mock.patch("stripe.PaymentIntent", self.stripe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self):
+        return stripe_client.call(
+            "PaymentIntent.create", amount=1000, currency="usd"
+        )
+
+    def open_breaker(self):
+        """Fail enough calls to open the breaker, returning the log."""
+        with self.assertLogs("checkout.stripe_client", "WARNING") as logs:
+            for _ in range(2):
+                with self.assertRaises(stripe_client.StripeUnavailable):
+                    self.create()
+        return logs.output
+
+    def test_breaker_opens_after_repeated_failures(self):
+        logs = self.open_breaker()
+        failures = [line for line in logs if "failed after" in line]
+        self.assertEqual(len(failures), 2)
+        self.assertIn("Stripe PaymentIntent.create failed", failures[0])
+        self.assertIn("timed out", failures[0])
+        self.assertIn(
+            "WARNING:checkout.stripe_client:"
+            "Stripe circuit breaker opened after 2 failures",
+            logs,
+        )
+
+        # Open: fails fast without calling Stripe
+        with self.assertRaises(stripe_client.StripeUnavailable):
+            self.create()
+        self.assertEqual(self.stripe.create.call_count, 2)
+        self.assertEqual(
+            self.metrics.snapshot()["PaymentIntent.create"]["errors"], 3
+        )
+
+    def test_breaker_closes_after_a_successful_trial_call(self):
+        self.open_breaker()
+        self.stripe.create.side_effect = None
+        self.breaker.opened_at -= 30
+
+        self.create()
+
+        self.assertIsNone(self.breaker.opened_at)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_request_errors_dont_count_as_failures(self):
+        self.stripe.create.side_effect = stripe.error.InvalidRequestError(
+            "Invalid amount", "amount"
+        )
+        for _ in range(3):
+            with self.assertRaises(stripe.error.InvalidRequestError):
+                self.create()
+
+        self.assertEqual(self.breaker.failures, 0)
+        self.assertIsNone(self.breaker.opened_at)
+
+    def test_retrieve_reuses_recently_fetched_objects(self):
+        objects = stripe_client.ObjectCache(timeout=60)
+        charge = stripe.Charge.construct_from({"id": "ch_1"}, "sk_test")
+        with mock.patch.object(stripe_client, "objects", objects):
+            with mock.patch(
+                "stripe.Charge.retrieve", return_value=charge
+            ) as retrieve:
+                for _ in range(3):
+                    self.assertEqual(
+                        stripe_client.retrieve("Charge", "ch_1"), charge
+                    )
+
+        retrieve.assert_called_once_with("ch_1")
+
+
+@override_settings(STRIPE_WH_SECRET="whsec_test")
+class StripeStandinCheckoutTests(TestCase):
+    """A payment through the local Stripe stand-in, with its webhook
+    verified, queued and processed into an order.
+    """
+
+    def setUp(self):
+        self.server = StandinServer()
+        self.server.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        for name, value in (
+            ("api_base", self.server.url),
+            ("api_key", "sk_test_standin"),
+        ):
+            patcher = mock.patch.object(stripe, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.product = Product.objects.create(
+            name="Test shirt", description="A shirt", price=Decimal("10.00")
+        )
+        self.bag = {str(self.product.pk): 2}
+
+    def pay(self):
+        """Create and confirm an intent, and return the event Stripe
+        would send for it.
+        """
+        intent = stripe_client.call(
+            "PaymentIntent.create", amount=2200, currency="usd"
+        )
+        stripe_client.call(
+            "PaymentIntent.modify",
+            intent.id,
+            metadata={
+                "bag": json.dumps(self.bag),
+                "save_info": "",
+                "username": "AnonymousUser",
+            },
+        )
+        self.server.stripe.confirm_payment_intent(
+            intent.id,
+            {
+                "payment_method_data": {
+                    "billing_details": {"email": "customer@example.com"}
+                },
+                "shipping": {
+                    "name": "A Customer",
+                    "phone": "0123456789",
+                    "address": {
+                        "line1": "1 Test Street",
+                        "city": "Leeds",
+                        "country": "GB",
+                        "postal_code": "LS1 1AA",
+                    },
+                },
+            },
+        )
+        intent = self.server.stripe.payment_intents[intent.id]
+        return build_event("payment_intent.succeeded", intent, "evt_test_1")
+
+    def post_event(self, event, secret="whsec_test"):
+        payload = json.dumps(event)
+        return self.client.post(
+            reverse("webhook"),
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, secret),
+        )
+
+    def test_signed_event_creates_the_order(self):
+        response = self.post_event(self.pay())
+        self.assertContains(response, "Queued")
+
+        call_command("process_webhooks", "--once", stdout=StringIO())
+
+        order = Order.objects.get()
+        self.assertEqual(order.email, "customer@example.com")
+        self.assertEqual(order.grand_total, Decimal("22.00"))
+        self.assertEqual(order.lineitems.get().quantity, 2)
+
+    def test_event_with_a_bad_signature_is_rejected(self):
+        response = self.post_event(self.pay(), secret="whsec_wrong")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+@override_settings(STRIPE_WH_SECRET="whsec_test")
+class WebhookQueueTests(TestCase):
+    """Events are stored once by the webhook view and processed, or
+    retried with backoff, by `process_webhooks`.
+    """
+
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.handler.return_value.dispatch.return_value = HttpResponse(
+            status=200
+        )
+        patcher = mock.patch(
+            "checkout.management.commands.process_webhooks"
+            ".StripeWebHookHandler",
+            self.handler,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_event(self, event_id="evt_test_1"):
+        payload = json.dumps(
+            build_event("payment_intent.succeeded", {"id": "pi_1"}, event_id)
+        )
+        return self.client.post(
+            reverse("webhook"),
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign_payload(payload, "whsec_test"),
+        )
+
+    def process(self, *args):
+        stderr = StringIO()
+        call_command(
+            "process_webhooks",
+            "--once",
+            "--backoff=10",
+            *args,
+            stdout=StringIO(),
+            stderr=stderr,
+        )
+        return stderr.getvalue()
+
+    def make_due(self):
+        WebhookEvent.objects.update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+
+    def test_duplicate_deliveries_are_stored_once(self):
+        self.assertContains(self.post_event(), "Queued")
+        self.assertContains(self.post_event(), "Duplicate")
+
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.process()
+        self.assertEqual(self.handler.return_value.dispatch.call_count, 1)
+
+    def test_processed_event_is_marked_done(self):
+        self.post_event()
+        self.process()
+
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE)
+        self.assertEqual(webhook_event.attempts, 1)
+        self.assertIsNotNone(webhook_event.processed_at)
+
+        # Done events aren't processed again
+        self.process()
+        self.assertEqual(self.handler.return_value.dispatch.call_count, 1)
+
+    def test_failed_event_is_retried_with_backoff(self):
+        self.handler.return_value.dispatch.side_effect = RuntimeError("down")
+        self.post_event()
+
+        started = timezone.now()
+        self.assertIn("Retrying", self.process())
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.PENDING)
+        self.assertEqual(webhook_event.attempts, 1)
+        self.assertEqual(webhook_event.last_error, "down")
+        self.assertGreaterEqual(
+            webhook_event.next_attempt_at, started + timedelta(seconds=10)
+        )
+
+        # Not due yet, so left alone
+        self.process()
+        self.assertEqual(WebhookEvent.objects.get().attempts, 1)
+
+        # The delay doubles on the next failure
+        self.make_due()
+        started = timezone.now()
+        self.process()
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.attempts, 2)
+        self.assertGreaterEqual(
+            webhook_event.next_attempt_at, started + timedelta(seconds=20)
+        )
+
+    def test_event_fails_after_max_attempts(self):
+        self.handler.return_value.dispatch.return_value = HttpResponse(
+            status=500
+        )
+        self.post_event()
+
+        for _ in range(3):
+            self.make_due()
+            self.process("--max-attempts=3")
+
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.FAILED)
+        self.assertEqual(webhook_event.attempts, 3)
+
+    def test_event_is_claimed_before_it_is_handled(self):
+        statuses = []
+
+        def dispatch(event):
+            statuses.append(WebhookEvent.objects.get().status)
+            return HttpResponse(status=200)
+
+        self.handler.return_value.dispatch.side_effect = dispatch
+        self.post_event()
+        self.process()
+
+        self.assertEqual(statuses, [WebhookEvent.PROCESSING])
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.DONE)
+
+    def test_stale_claims_are_processed_again(self):
+        self.post_event()
+        WebhookEvent.objects.update(
+            status=WebhookEvent.PROCESSING,
+            claimed_at=timezone.now() - timedelta(seconds=30),
+            attempts=1,
+        )
+
+        # Another worker may still be handling it
+        self.process("--claim-timeout=60")
+        self.handler.return_value.dispatch.assert_not_called()
+
+        self.process("--claim-timeout=10")
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE)
+        self.assertEqual(webhook_event.attempts, 2)
+
+    def test_retried_event_succeeds(self):
+        self.handler.return_value.dispatch.side_effect = [
+            RuntimeError("down"),
+            HttpResponse(status=200),
+        ]
+        self.post_event()
+        self.process()
+        self.make_due()
+        self.process()
+
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE)
+        self.assertEqual(webhook_event.attempts, 2)
+        self.assertEqual(webhook_event.last_error, "")
+
+
+@override_settings(
+    EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+)
+class OutboxTests(TestCase):
+    """Queued emails are claimed, sent, and retried with backoff by
+    `send_outbox_emails`.
+    """
+
+    send_messages = (
+        "django.core.mail.backends.locmem.EmailBackend.send_messages"
+    )
+
+    def queue_email(self, to_email="customer@example.com"):
+        return OutboundEmail.objects.create(
+            subject="Order confirmation",
+            body="Thanks for your order",
+            from_email="shop@example.com",
+            to_email=to_email,
+        )
+
+    def send(self, *args):
+        stderr = StringIO()
+        call_command(
+            "send_outbox_emails",
+            "--once",
+            "--backoff=10",
+            *args,
+            stdout=StringIO(),
+            stderr=stderr,
+        )
+        return stderr.getvalue()
+
+    def make_due(self):
+        OutboundEmail.objects.update(
+            next_attempt_at=timezone.now() - timedelta(seconds=1)
+        )
+
+    def test_queued_emails_are_sent_once(self):
+        self.queue_email("one@example.com")
+        self.queue_email("two@example.com")
+        self.send()
+
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["one@example.com", "two@example.com"],
+        )
+        for email in OutboundEmail.objects.all():
+            self.assertEqual(email.status, OutboundEmail.SENT)
+            self.assertEqual(email.attempts, 1)
+            self.assertIsNotNone(email.sent_at)
+
+        # Sent emails aren't sent again
+        self.send()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_emails_are_claimed_before_sending(self):
+        self.queue_email()
+        statuses = []
+
+        def send_messages(messages):
+            statuses.append(OutboundEmail.objects.get().status)
+            return len(messages)
+
+        with mock.patch(self.send_messages, side_effect=send_messages):
+            self.send()
+        self.assertEqual(statuses, [OutboundEmail.SENDING])
+        self.assertEqual(
+            OutboundEmail.objects.get().status, OutboundEmail.SENT
+        )
+
+    def test_failed_email_is_retried_with_backoff(self):
+        self.queue_email()
+
+        started = timezone.now()
+        with mock.patch(self.send_messages, side_effect=OSError("down")):
+            self.send()
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.status, OutboundEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, "down")
+        self.assertGreaterEqual(
+            email.next_attempt_at, started + timedelta(seconds=10)
+        )
+
+        # Not due yet, so left alone
+        self.send()
+        self.assertEqual(mail.outbox, [])
+
+        self.make_due()
+        self.send()
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.status, OutboundEmail.SENT)
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(email.last_error, "")
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_email_fails_after_max_attempts(self):
+        self.queue_email()
+
+        with mock.patch(self.send_messages, side_effect=OSError("down")):
+            for _ in range(3):
+                self.make_due()
+                stderr = self.send("--max-attempts=3")
+
+        self.assertIn("Failed", stderr)
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+        self.assertEqual(email.attempts, 3)
+
+        # Failed emails aren't retried
+        self.make_due()
+        self.send("--max-attempts=3")
+        self.assertEqual(mail.outbox, [])
+
+    def test_stale_claims_are_sent_again(self):
+        email = self.queue_email()
+        now = timezone.now()
+        OutboundEmail.objects.filter(pk=email.pk).update(
+            status=OutboundEmail.SENDING,
+            claimed_at=now - timedelta(seconds=30),
+            attempts=1,
+        )
+
+        # Another sender may still be working on it
+        self.send("--claim-timeout=60")
+        self.assertEqual(mail.outbox, [])
+
+        self.send("--claim-timeout=10")
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.SENT)
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class CreateOrderTests(TestCase):
+    def setUp(self):
+        self.products = [
+            Product.objects.create(
+                name=f"Test shirt {n}",
+                description="A shirt",
+                price=Decimal("10.00"),
+            )
+            for n in range(20)
+        ]
+
+    def new_order(self):
+        return Order(
+            full_name="A Customer",
+            email="customer@example.com",
+            phone_number="0123456789",
+            country="GB",
+            town_or_city="Leeds",
+            street_address1="1 Test Street",
+        )
+
+    def count_queries(self, bag):
+        with CaptureQueriesContext(connection) as queries:
+            create_order(self.new_order(), bag)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_the_bag(self):
+        small = {str(self.products[0].pk): 1}
+        large = {str(product.pk): 2 for product in self.products[1:]}
+        large[str(self.products[0].pk)] = {
+            "items_by_size": {"s": 1, "m": 1, "l": 1}
+        }
+
+        self.assertEqual(self.count_queries(large), self.count_queries(small))
+
+    def test_totals_are_calculated_from_the_bag(self):
+        bag = {
+            str(self.products[0].pk): 2,
+            str(self.products[1].pk): {"items_by_size": {"s": 1, "m": 1}},
+        }
+        order = create_order(self.new_order(), bag)
+
+        order.refresh_from_db()
+        self.assertEqual(order.lineitems.count(), 3)
+        self.assertEqual(order.order_total, Decimal("40.00"))
+        self.assertEqual(order.delivery_cost, Decimal("4.00"))
+        self.assertEqual(order.grand_total, Decimal("44.00"))
+
+    def test_missing_product_creates_nothing(self):
+        bag = {str(self.products[0].pk): 1, "999999": 1}
+
+        with self.assertRaises(Product.DoesNotExist):
+            create_order(self.new_order(), bag)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderLineItem.objects.exists())
+
+
+class OrderTotalSignalTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Test shirt", description="A shirt", price=Decimal("10.00")
+        )
+        self.order = Order.objects.create(
+            full_name="A Customer",
+            email="customer@example.com",
+            phone_number="0123456789",
+            country="GB",
+            town_or_city="Leeds",
+            street_address1="1 Test Street",
+        )
+
+    def add_line_item(self, quantity=1):
+        OrderLineItem.objects.create(
+            order=self.order, product=self.product, quantity=quantity
+        )
+
+    def test_one_update_per_transaction(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for _ in range(3):
+                self.add_line_item()
+
+        self.assertEqual(len(callbacks), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.order_total, Decimal("30.00"))
+
+    def test_update_survives_a_rolled_back_savepoint(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.add_line_item(quantity=5)
+                    raise RuntimeError("rolled back")
+            except RuntimeError:
+                pass
+            self.add_line_item(quantity=2)
+
+        self.assertEqual(len(callbacks), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.order_total, Decimal("20.00"))
+
+    def test_pending_orders_are_cleared_when_the_update_fails(self):
+        with mock.patch(
+            "checkout.signals.update_order_totals",
+            side_effect=RuntimeError("down"),
+        ):
+            with self.assertRaises(RuntimeError):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.add_line_item()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.add_line_item()
+        self.assertEqual(len(callbacks), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.order_total, Decimal("20.00"))
+
+
+class GetOrCreateOrderTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Test shirt", description="A shirt", price=Decimal("10.00")
+        )
+        self.bag = {str(self.product.pk): 1}
+
+    def new_order(self):
+        return Order(
+            full_name="A Customer",
+            email="customer@example.com",
+            phone_number="0123456789",
+            country="GB",
+            town_or_city="Leeds",
+            street_address1="1 Test Street",
+            stripe_pid="pi_test",
+        )
+
+    def test_returns_the_existing_order_for_the_payment(self):
+        first, created = get_or_create_order(self.new_order(), self.bag)
+        second, created_again = get_or_create_order(self.new_order(), self.bag)
+
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(first, second)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_concurrent_create_returns_the_other_callers_order(self):
+        def racing_create_order(order, bag):
+            # The other caller creates the order after our lookup
+            other_order = create_order(self.new_order(), bag)
+            self.other_order = other_order
+            return create_order(order, bag)
+
+        with mock.patch("checkout.services.create_order", racing_create_order):
+            order, created = get_or_create_order(self.new_order(), self.bag)
+
+        self.assertFalse(created)
+        self.assertEqual(order, self.other_order)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(OrderLineItem.objects.count(), 1)
+
+
+class CheckoutSuccessTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("customer", password="password")
+        self.client.force_login(self.user)
+        product = Product.objects.create(
+            name="Test shirt",
+            description="A shirt",
+            price=Decimal("10.00"),
+            image="test-shirt.jpg",
+        )
+        self.client.post(
+            reverse("add_to_bag", args=[product.pk]),
+            {"quantity": 1, "redirect_url": "/"},
+        )
+
+    def place_order(self, **extra):
+        return self.client.post(
+            reverse("checkout"),
+            {
+                "full_name": "A Customer",
+                "email": "customer@example.com",
+                "phone_number": "0123456789",
+                "country": "GB",
+                "postcode": "LS1 1AA",
+                "town_or_city": "Leeds",
+                "street_address1": "1 Test Street",
+                "street_address2": "",
+                "county": "",
+                "client_secret": "pi_test_secret_test",
+                **extra,
+            },
+        )
+
+    def test_placing_an_order_attaches_the_profile_and_saves_info(self):
+        self.place_order(**{"save-info": "on"})
+
+        order = Order.objects.get()
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(order.user_profile, profile)
+        self.assertEqual(profile.default_postcode, "LS1 1AA")
+        # Already up to date, so nothing to save
+        self.assertFalse(profile.update_defaults_from_order(order))
+
+    def test_success_page_writes_nothing(self):
+        response = self.place_order(**{"save-info": "on"})
+
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(response.url)
+            writes = [
+                query["sql"]
+                for query in queries
+                if query["sql"].startswith(("INSERT", "UPDATE", "DELETE"))
+                # Reading the success message updates the session
+                and "django_session" not in query["sql"]
+            ]
+            self.assertEqual(writes, [])
+
+
+class OrderDetailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(
+                name=f"Test shirt {n}",
+                description="A shirt",
+                price=Decimal("10.00"),
+            )
+            for n in range(5)
+        ]
+        self.order = create_order(
+            Order(
+                full_name="A Customer",
+                email="customer@example.com",
+                phone_number="0123456789",
+                country="GB",
+                town_or_city="Leeds",
+                street_address1="1 Test Street",
+            ),
+            {str(product.pk): 1 for product in self.products},
+        )
+        self.url = reverse("checkout_success", args=[self.order.order_number])
+
+    def get(self, url=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url or self.url)
+        return response, [query["sql"] for query in queries]
+
+    def test_line_items_are_prefetched_then_cached(self):
+        response, queries = self.get()
+        self.assertContains(response, "Test shirt 4")
+        # One query each for the order, its line items and their products
+        self.assertEqual(
+            len([sql for sql in queries if "checkout_order" in sql]), 2
+        )
+        self.assertEqual(
+            len([sql for sql in queries if "products_product" in sql]), 1
+        )
+
+        response, queries = self.get()
+        self.assertContains(response, "Test shirt 4")
+        self.assertFalse(
+            [sql for sql in queries if "checkout_orderlineitem" in sql]
+        )
+
+    def test_order_history_shares_the_cached_details(self):
+        self.get()
+        user = User.objects.create_user("customer", password="password")
+        self.client.force_login(user)
+
+        response, queries = self.get(
+            reverse("order_history", args=[self.order.order_number])
+        )
+        self.assertContains(response, "Test shirt 4")
+        self.assertFalse(
+            [sql for sql in queries if "checkout_orderlineitem" in sql]
+        )
+
+    def test_saving_the_order_drops_its_cached_details(self):
+        self.get()
+        self.order.full_name = "Another Customer"
+        self.order.save()
+
+        response, _ = self.get()
+        self.assertContains(response, "Another Customer")
+
+    def test_recalculating_totals_drops_cached_details(self):
+        self.get()
+        OrderLineItem.objects.filter(order=self.order).update(
+            lineitem_total=Decimal("20.00")
+        )
+        update_order_totals([self.order.pk])
+
+        response, _ = self.get()
+        self.assertContains(response, "100.00")
+
+    def test_catalog_changes_drop_cached_details(self):
+        self.get()
+        self.products[0].name = "Renamed shirt"
+        self.products[0].save()
+
+        response, _ = self.get()
+        self.assertContains(response, "Renamed shirt")
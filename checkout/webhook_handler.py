@@ -1,16 +1,15 @@
 import json
-import time
 
-import stripe
 from django.http import HttpResponse
 
 # Handle checkbox profile save
 from profiles.models import UserProfile
 
-from .models import Order, OrderLineItem, Product
+from . import stripe_client
+from .models import Order, OutboundEmail
+from .services import get_or_create_order
 
-# SEND CONFIRMATION EMAIL IMPORTS
-from django.core.mail import send_mail
+# CONFIRMATION EMAIL IMPORTS
 from django.template.loader import render_to_string
 from django.conf import settings
 
@@ -18,17 +17,43 @@ from django.conf import settings
 class StripeWebHookHandler:
     """Handle Stripe webhooks."""
 
-    def __init__(self, request):
+    def __init__(self, request=None):
         """Setup method each time an instance of this class is created.
 
         Arguments:
-            request -- enable access to any request attrs coming from Stripe
+            request -- enable access to any request attrs coming from Stripe,
+                or `None` when handling a queued event in the worker
         """
         self.request = request
 
+    def dispatch(self, event):
+        """Call the handler method for the event's type.
+
+        Arguments:
+            event -- the Stripe event to handle
+
+        Returns:
+            the HTTP response from the handler method
+        """
+        # Map webhook events to appropriate handler functions
+        event_map = {
+            "payment_intent.succeeded": self.handle_payment_intent_success,
+            "payment_intent.payment_failed": self.handle_payment_intent_fail,
+        }
+
+        # Lookup the key in the dictionary to assign the var
+        # Optional generic handler default provided
+        event_handler = event_map.get(event["type"], self.handle_event)
+
+        # Call the event handler with the event
+        return event_handler(event)
+
     # PRIVATE METHOD (only used in this class)
     def _send_confirmation_email(self, order):
-        """Send the user a confirmation email"""
+        """Queue the user a confirmation email in the outbox.
+
+        The `send_outbox_emails` command delivers it.
+        """
         cust_email = order.email
         # Template and context provided for render_to_string method
         subject = render_to_string(
@@ -40,9 +65,14 @@ class StripeWebHookHandler:
             {"order": order, "contact_email": settings.DEFAULT_FROM_EMAIL},
         )
 
-        # Method to actually send the email
         # Subject, Body, From, To
-        send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, [cust_email])
+        # Headers can't contain newlines, so tidy up the rendered subject
+        OutboundEmail.objects.create(
+            subject=" ".join(subject.split()),
+            body=body,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to_email=cust_email,
+        )
 
     def handle_event(self, event):
         """Handle generic, unknown or unexpected webhook events.
@@ -57,6 +87,23 @@ class StripeWebHookHandler:
             content=f"Unhandled webhook received: {event['type']}", status=200
         )
 
+    # PRIVATE METHOD (only used in this class)
+    def _get_charge(self, intent):
+        """Return the intent's latest charge, for its billing details.
+
+        The charge is taken from the event payload when it's there: an
+        expanded `latest_charge`, or the `charges` list sent with older
+        API versions. Otherwise it's fetched from Stripe, reusing a
+        recently fetched copy, e.g. when a failed event is retried.
+        """
+        latest_charge = intent.get("latest_charge")
+        if isinstance(latest_charge, dict):
+            return latest_charge
+        charges = intent.get("charges")
+        if charges and charges.get("data"):
+            return charges["data"][0]
+        return stripe_client.retrieve("Charge", latest_charge)
+
     # SPECIFIC EVENT HANDLING METHODS
     def handle_payment_intent_success(self, event):
         # Payment intent - all customer information held here
@@ -69,14 +116,9 @@ class StripeWebHookHandler:
         save_info = intent.metadata.save_info
 
         # UPDATE https://learn.codeinstitute.net/courses/course-v1:CodeInstitute+EA101+2021_T1/courseware/eb05f06e62c64ac89823cc956fcd8191/48ac02aa8ecc4079be016c336231bee7/?child=first
-        # Get the Charge object
-        stripe_charge = stripe.Charge.retrieve(intent.latest_charge)
-
         # billing_details = intent.charges.data[0].billing_details
-        billing_details = stripe_charge.billing_details  # updated
+        billing_details = self._get_charge(intent).billing_details
         shipping_details = intent.shipping
-        # grand_total = round(intent.data.charges[0].amount / 100, 2)
-        grand_total = round(stripe_charge.amount / 100, 2)  # updated
 
         # Store empty string values as 'None' for our database (clean)
         for field, value in shipping_details.address.items():
@@ -90,58 +132,58 @@ class StripeWebHookHandler:
         if username != "AnonymousUser":
             # They must be authenticated
             profile = UserProfile.objects.get(user__username=username)
-            # If checkbox clicked
-            if save_info:
-                profile.default_phone_number = shipping_details.phone
-                profile.default_country = shipping_details.address.country
-                profile.default_postcode = shipping_details.address.postal_code
-                profile.default_town_or_city = shipping_details.address.city
-                profile.default_street_address1 = (
-                    shipping_details.address.line1
-                )
-                profile.default_street_address2 = (
-                    shipping_details.address.line2
-                )
-                profile.default_county = shipping_details.address.state
-                profile.save()
+
+        # Build the order from the PaymentIntent, just like the form
+        order = Order(
+            full_name=shipping_details.name,
+            # WE GOT THE PROFILE ALREADY ABOVE
+            # LET WH CREATE ORDERS FOR AUTH AND ANON USERS
+            # e.g. PROFILE DATA OR 'NONE'
+            user_profile=profile,
+            email=billing_details.email,
+            phone_number=shipping_details.phone,
+            country=shipping_details.address.country,
+            postcode=shipping_details.address.postal_code,
+            town_or_city=shipping_details.address.city,
+            street_address1=shipping_details.address.line1,
+            street_address2=shipping_details.address.line2,
+            county=shipping_details.address.state,
+            # INCLUDE FIELDS TO CREATE SPECIFIC ORDER
+            original_bag=bag,
+            stripe_pid=pid,
+        )
+
+        # If checkbox clicked, save the details as the profile's defaults,
+        # writing only what changed
+        if profile and save_info:
+            profile.update_defaults_from_order(order)
 
         # For proper form submission when the user checks out, the form
         # should already be in the db
         # Presence check and return an ok response if it is there
 
-        # First, assume the order doesn't exist
-        order_exists = False
-
-        # CREATE DELAY INSTEAD OF IMMEDIATE CREATION WHEN RECORD NOT FOUND
-        attempt = 1
-        while attempt < 5:
-            try:
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=shipping_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.country,
-                    postcode__iexact=shipping_details.postal_code,
-                    town_or_city__iexact=shipping_details.city,
-                    street_address1__iexact=shipping_details.line1,
-                    street_address2__iexact=shipping_details.line2,
-                    county__iexact=shipping_details.state,
-                    grand_total=grand_total,
-                    # ADDITIONAL CHECKS AFTER DUPLICATE BAG LOGIC IMPLEMENTED
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                # BREAK WHILE LOOP IF ORDER FOUND
-                break
-
-            except Order.DoesNotExist:
-                # DELAY LOGIC
-                attempt += 1
-                # SLEEP FOR ONE SECOND
-                time.sleep(1)
-
-        if order_exists:
+        # `stripe_pid` is unique, so the lookup is a single index lookup
+        # and the checkout view and the webhook can never both create an
+        # order for this payment. There's no waiting for the checkout view
+        # here: if the order isn't there yet the webhook creates it, and
+        # the checkout view uses this order instead of creating its own
+        try:
+            # Create if it does not exist, using the same service as the
+            # checkout view
+            # LOAD BAG FROM JSON VERSION OF PAYMENTINTENT, NOT SESSION
+            order, created = get_or_create_order(order, json.loads(bag))
+
+        except Exception as e:
+            # The order is created in a single transaction, so nothing is
+            # saved if anything goes wrong
+            # 500 error causes Stripe to automatically try the webhook
+            # again later
+            return HttpResponse(
+                content=f"Webhook received: {event['type']} | ERROR: {e}",
+                status=500,
+            )
+
+        if not created:
             # SEND CONFIRMATION EMAIL HERE BEFORE RETURNING RESPONSE TO STRIPE
             self._send_confirmation_email(order)
             return HttpResponse(
@@ -149,68 +191,6 @@ class StripeWebHookHandler:
                 status=200,
             )
 
-        else:
-            order = None
-            try:
-                # Create if it does not exist, using code from checkout view
-                order = Order.objects.create(
-                    full_name=shipping_details.name,
-                    # WE GOT THE PROFILE ALREADY ABOVE
-                    # LET WH CREATE ORDERS FOR AUTH AND ANON USERS
-                    # e.g. PROFILE DATA OR 'NONE'
-                    user_profile=profile,
-                    email=shipping_details.email,
-                    phone_number=shipping_details.phone,
-                    country=shipping_details.country,
-                    postcode=shipping_details.postal_code,
-                    town_or_city=shipping_details.city,
-                    street_address1=shipping_details.line1,
-                    street_address2=shipping_details.line2,
-                    county=shipping_details.state,
-                    # INCLUDE FIELDS TO CREATE SPECIFIC ORDER
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                # Iterate through bag items to create line items
-                # LOAD BAG FROM JSON VERSION OF PAYMENTINTENT, NOT SESSION
-                for item_id, item_data in json.loads(bag).items():
-                    # WE DON'T HAVE A FORM TO SAVE IN THIS WEBHOOK TO CREATE THE ORDER
-                    # CREATE IT HERE USING DATA FROM THE PAYMENTINTENT (WHICH CAME FROM THE FORM)
-                    product = Product.objects.get(id=item_id)
-                    # For items without sizes
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    # Create line items for items with sizes
-                    else:
-                        for size, quantity in item_data[
-                            "items_by_size"
-                        ].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-
-            except Exception as e:
-                # IF ANYTHING GOES WRONG, DELETE THE ORDER IF IT WAS CREATED
-                # 500 error causes Stripe to automatically try the webhook
-                # again later
-                if order:
-                    order.delete()
-                return HttpResponse(
-                    content=f"Webhook received: {event['type']} | ERROR: {e}",
-                    status=500,
-                )
-
-        print(intent)
-
         # SEND CONFIRMATION EMAIL IF ORDER CREATED BY WEBHOOK HANDLER
         self._send_confirmation_email(order)
 
@@ -1,7 +1,6 @@
-import json
-
 import stripe
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
 
 from django.views.decorators.http import require_POST
@@ -9,8 +8,8 @@ from django.views.decorators.http import require_POST
 # Stripe won't send a CSRF token so we will need this
 from django.views.decorators.csrf import csrf_exempt
 
-# OUR WEBHOOK HANDLER
-from checkout.webhook_handler import StripeWebHookHandler
+# Verified events are queued for the webhook handler
+from checkout.models import WebhookEvent
 
 
 @require_POST
@@ -27,7 +26,6 @@ def webhook(request):
     """
     # SETUP
     wh_secret = settings.STRIPE_WH_SECRET
-    stripe.api_key = settings.STRIPE_SECRET_KEY
 
     # Get webhook data and verify its signature
     payload = request.body
@@ -49,27 +47,32 @@ def webhook(request):
     except Exception as e:
         return HttpResponse(content=e, status=400)
 
-    # print("Success!")
-    # return HttpResponse(status=200)
-
-    # Set up webhook handler
-    handler = StripeWebHookHandler(request)
-
-    # Map webhook events to appropriate handler functions
-    event_map = {
-        "payment_intent.succeeded": handler.handle_payment_intent_success,
-        "payment_intent.payment_failed": handler.handle_payment_intent_fail,
-    }
-
-    # Get webhook type from Stripe
-    # example return payment_intent.succeeded
-    event_type = event["type"]
-
-    # Lookup the key in the dictionary to assign the var
-    # Optional generic handler default provided
-    event_handler = event_map.get(event_type, handler.handle_event)
-
-    # Call the event handler with the event
-    response = event_handler(event)
-    print(response.content)
-    return response
+    # Stripe retries deliveries it thinks failed, so the same event can
+    # arrive more than once. Events already in the ledger are
+    # acknowledged without being queued or processed again
+    if WebhookEvent.objects.filter(event_id=event["id"]).exists():
+        return HttpResponse(
+            content=f"Webhook received: {event['type']} | Duplicate",
+            status=200,
+        )
+
+    # Store the event for the `process_webhooks` worker and acknowledge
+    # it straight away, so slow order processing, Stripe API calls or
+    # emails never hold up the response to Stripe
+    try:
+        with transaction.atomic():
+            WebhookEvent.objects.create(
+                event_id=event["id"],
+                event_type=event["type"],
+                payload=payload.decode("utf-8"),
+            )
+    except IntegrityError:
+        # A concurrent delivery of the same event stored it first
+        return HttpResponse(
+            content=f"Webhook received: {event['type']} | Duplicate",
+            status=200,
+        )
+
+    return HttpResponse(
+        content=f"Webhook received: {event['type']} | Queued", status=200
+    )
@@ -69,6 +69,8 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # Lazy `request.user_profile`, see `profiles/middleware.py`
+    "profiles.middleware.UserProfileMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -134,6 +136,26 @@ else:
 
 # DATABASES = {"default": dj_database_url.parse("")}
 
+# Caching
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+# In production the cache is shared by all gunicorn workers, so that
+# catalog changes invalidate cached listings everywhere at once. The
+# table is created by `createcachetable` in the Procfile release phase
+if "DATABASE_URL" in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "django_cache",
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 # Log allauth account confirmation emails to the console
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
@@ -232,12 +254,42 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 FREE_DELIVERY_THRESHOLD = 50
 STANDARD_DELIVERY_PERCENTAGE = 10
 
+# Product listing pagination; `?page_size=` can't go above the maximum
+PRODUCTS_PAGE_SIZE = 24
+PRODUCTS_MAX_PAGE_SIZE = 96
+# Seconds to cache product listing pages and counts. Listings are also
+# invalidated whenever a product or category changes
+PRODUCTS_LISTING_CACHE_TIMEOUT = 60 * 60
+
+# Orders per page of the order history on the profile page
+PROFILE_ORDERS_PAGE_SIZE = 10
+# Seconds to cache an order's rendered details, see `checkout/cache.py`
+ORDER_DETAIL_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Where the shopping bag is stored; `bag.backends.SessionBagBackend`
+# keeps it as JSON in the session instead
+BAG_BACKEND = "bag.backends.DatabaseBagBackend"
+
 # STRIPE
 
 STRIPE_CURRENCY = "usd"
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_WH_SECRET = os.getenv("STRIPE_WH_SECRET", "")
+# Point the Stripe API client somewhere else, e.g. at the local stand-in
+# from `python manage.py stripe_standin`
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "")
+# Stripe API client, see `checkout/stripe_client.py`. Timeouts are in
+# seconds; after `STRIPE_BREAKER_THRESHOLD` failures in a row, calls fail
+# fast for `STRIPE_BREAKER_RESET_TIMEOUT` seconds
+STRIPE_CONNECT_TIMEOUT = 3
+STRIPE_READ_TIMEOUT = 10
+STRIPE_MAX_NETWORK_RETRIES = 2
+STRIPE_POOL_SIZE = 10
+STRIPE_BREAKER_THRESHOLD = 5
+STRIPE_BREAKER_RESET_TIMEOUT = 30
+# Seconds to reuse objects fetched with `stripe_client.retrieve`
+STRIPE_OBJECT_CACHE_TIMEOUT = 300
 
 # ORDER CONFIRMATION EMAIL
 
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        """Override the `ready()` method to import the signals module,
+        to invalidate cached listings every time a product or category
+        is saved or deleted.
+        """
+        import products.signals  # noqa: F401
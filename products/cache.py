@@ -0,0 +1,76 @@
+"""Caching for product listings.
+
+Listing results are cached as ordered lists of product ids, keyed on the
+normalized search, category, sort and page params. Every key includes a
+catalog version number, which `signals.py` bumps whenever a `Product` or
+`Category` is saved or deleted. Bumping the version makes every cached
+listing unreachable at once, and the old entries expire on their own.
+
+The version lives in the default cache, so with a cache shared between
+gunicorn workers (see `CACHES` in settings) one bump invalidates the
+listings in every worker. With the per-process locmem cache each worker
+keeps its own version, which is fine for local development.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+CATALOG_VERSION_KEY = "products:catalog_version"
+
+
+def get_catalog_version():
+    """Return the current catalog version, starting it at 1."""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # `add` so concurrent workers don't reset each other's bumps
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every cached listing."""
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # No version yet (or it was evicted), so nothing is cached under it
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+
+
+def normalize_params(query=None, categories=None, sort=None, direction=None):
+    """Reduce listing params to a canonical form, so e.g. `?q=Shirt ` and
+    `?q=shirt` or `?category=a,b` and `?category=b,a` share an entry.
+    """
+    return {
+        "q": " ".join(query.split()).casefold() if query else None,
+        "category": sorted(set(categories)) if categories else None,
+        "sort": sort,
+        "direction": direction if sort else None,
+    }
+
+
+def listing_cache_key(kind, params, **extra):
+    """Build a versioned cache key for a listing.
+
+    Arguments:
+        kind -- what is cached, e.g. `"page"` or `"count"`
+        params -- normalized listing params from `normalize_params`
+        extra -- anything else the cached value depends on
+    """
+    source = json.dumps({**params, **extra}, sort_keys=True)
+    digest = hashlib.md5(source.encode()).hexdigest()
+    return f"products:{kind}:v{get_catalog_version()}:{digest}"
+
+
+def get_or_set_listing(kind, params, default, **extra):
+    """Return the cached value for a listing, calling `default()` to
+    build and cache it on a miss.
+    """
+    return cache.get_or_set(
+        listing_cache_key(kind, params, **extra),
+        default,
+        settings.PRODUCTS_LISTING_CACHE_TIMEOUT,
+    )
@@ -0,0 +1,235 @@
+"""Keyset (cursor) pagination for product listings.
+
+Instead of `OFFSET`, each page asks the database for the rows that come
+after (or before) the last row the customer saw, using the values of
+the sort keys of that row. The database can then use an index to jump
+straight to the page, and pages stay stable when products are added or
+removed between requests.
+
+https://use-the-index-luke.com/no-offset
+
+Ordering is given as a list of field names as for `order_by()`, e.g.
+`["-price"]`. The primary key is always added as a final tie-breaker so
+that every row has a unique position. NULL sort values (e.g. products
+without a rating) are always treated as the smallest value, so they come
+first in ascending order and last in descending order on every database.
+Columns that can't be NULL are sorted and compared without that
+handling, so a plain index on them can serve the ordering.
+
+Cursors are signed, so they can't be tampered with to inject values
+into the query.
+"""
+
+from datetime import date
+from decimal import Decimal
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+
+CURSOR_SALT = "products.pagination.cursor"
+
+
+class Page:
+    """A single page of results plus cursors for its neighbours."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(data):
+    return signing.dumps(data, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    """Return the cursor data, or `None` for a missing or bad cursor."""
+    if not cursor:
+        return None
+    try:
+        return signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+
+
+def _serialize(value):
+    """Make a sort value JSON friendly for the cursor."""
+    if isinstance(value, Decimal):
+        return str(value)
+    # Dates and datetimes are parsed back from ISO format when filtering
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _nullable(model, key):
+    """Whether a sort key can be NULL; names that aren't a field of the
+    model, such as lookups across relations, are assumed to be.
+    """
+    if key in ("pk", "id"):
+        return False
+    try:
+        return model._meta.get_field(key).null
+    except FieldDoesNotExist:
+        return True
+
+
+def _after(key, value, descending, nullable=True):
+    """Q object for rows that come after `value` on a single sort key."""
+    if not nullable:
+        lookup = "lt" if descending else "gt"
+        return Q(**{f"{key}__{lookup}": value})
+    if descending:
+        # NULL is the smallest value, so nothing comes after it
+        if value is None:
+            return Q(pk__in=[])
+        return Q(**{f"{key}__lt": value}) | Q(**{f"{key}__isnull": True})
+    if value is None:
+        return Q(**{f"{key}__isnull": False})
+    return Q(**{f"{key}__gt": value})
+
+
+def _equal(key, value):
+    if value is None:
+        return Q(**{f"{key}__isnull": True})
+    return Q(**{key: value})
+
+
+def _keyset_filter(keys, values):
+    """Q object for rows after `values` in lexicographic key order.
+
+    For keys (a, b, pk) this builds:
+    a > v1 OR (a = v1 AND b > v2) OR (a = v1 AND b = v2 AND pk > v3)
+    """
+    condition = Q(pk__in=[])
+    equal_so_far = Q()
+    for (key, descending, nullable), value in zip(keys, values):
+        condition |= equal_so_far & _after(key, value, descending, nullable)
+        equal_so_far &= _equal(key, value)
+    return condition
+
+
+def _order_by(keys):
+    orderings = []
+    for key, descending, nullable in keys:
+        if not nullable:
+            orderings.append(F(key).desc() if descending else F(key).asc())
+        elif descending:
+            orderings.append(F(key).desc(nulls_last=True))
+        else:
+            orderings.append(F(key).asc(nulls_first=True))
+    return orderings
+
+
+def paginate_keyset(queryset, ordering, cursor=None, page_size=24):
+    """Return one `Page` of `queryset` in the given `ordering`.
+
+    Arguments:
+        queryset -- the queryset to paginate (its ordering is replaced)
+        ordering -- list of field/annotation names, `-` for descending
+        cursor -- an opaque cursor from a previous page, if any
+        page_size -- maximum number of rows on the page
+    """
+    original_queryset = queryset
+    keys = [
+        (
+            name.lstrip("-"),
+            name.startswith("-"),
+            _nullable(queryset.model, name.lstrip("-")),
+        )
+        for name in ordering
+    ]
+    if not keys or keys[-1][0] not in ("pk", "id"):
+        # Tie-break on the primary key in the same direction as the sort
+        keys.append(("pk", keys[0][1] if keys else False, False))
+
+    # Expose every sort key under a predictable name so it can be read
+    # back off each row and compared against in the keyset filter
+    aliases = [
+        (f"keyset_{i}", descending, nullable)
+        for i, (key, descending, nullable) in enumerate(keys)
+    ]
+    queryset = queryset.annotate(
+        **{alias[0]: F(key[0]) for alias, key in zip(aliases, keys)}
+    )
+
+    data = decode_cursor(cursor)
+    backwards = False
+    # Cursors only apply to the ordering they were created for
+    if data and data.get("ordering") == ordering:
+        backwards = data.get("direction") == "previous"
+        if backwards:
+            # Walk the index the other way from the cursor row
+            aliases = [
+                (alias, not desc, nullable)
+                for alias, desc, nullable in aliases
+            ]
+        queryset = queryset.filter(_keyset_filter(aliases, data["values"]))
+    else:
+        data = None
+
+    # One extra row tells us whether there is another page
+    rows = list(queryset.order_by(*_order_by(aliases))[: page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        if not has_more:
+            # Reached the start of the listing, so show a full first page
+            return paginate_keyset(
+                original_queryset, ordering, None, page_size
+            )
+        rows.reverse()
+
+    def cursor_for(row, direction):
+        values = [_serialize(getattr(row, alias)) for alias, *_ in aliases]
+        return encode_cursor(
+            {"ordering": ordering, "direction": direction, "values": values}
+        )
+
+    next_cursor = previous_cursor = None
+    if rows:
+        # Moving forwards there is a previous page whenever we came from
+        # a cursor; moving backwards there is always a next page
+        if has_more or backwards:
+            next_cursor = cursor_for(rows[-1], "next")
+        if data:
+            previous_cursor = cursor_for(rows[0], "previous")
+    return Page(rows, next_cursor, previous_cursor)
+
+
+def paginate_offset(queryset, cursor=None, page_size=24):
+    """Offset pagination with the same interface as `paginate_keyset`.
+
+    Used for orderings that can't be expressed as a keyset, such as
+    search relevance, where the rank is a computed float.
+    """
+    data = decode_cursor(cursor)
+    offset = 0
+    if data and isinstance(data.get("offset"), int):
+        offset = max(data["offset"], 0)
+
+    rows = list(queryset[offset : offset + page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    next_cursor = previous_cursor = None
+    if has_more:
+        next_cursor = encode_cursor({"offset": offset + page_size})
+    if offset:
+        previous_cursor = encode_cursor({"offset": max(offset - page_size, 0)})
+    return Page(rows, next_cursor, previous_cursor)
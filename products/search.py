@@ -0,0 +1,112 @@
+"""Full-text search over the product catalogue.
+
+The search index lives in the database and is created by migration
+`0003_product_search_index`:
+
+- PostgreSQL: a stored, generated `tsvector` column (`search_vector`)
+  with a GIN index. Postgres keeps the column up to date itself.
+- SQLite: an external content FTS5 table (`products_product_fts`) kept
+  in sync with `products_product` by insert/update/delete triggers.
+
+Any other backend, or an SQLite build without FTS5, falls back to the
+original `icontains` lookups so search keeps working.
+
+https://www.postgresql.org/docs/current/textsearch-tables.html
+https://www.sqlite.org/fts5.html#external_content_tables
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "products_product_fts"
+
+# Cache of `connection alias -> bool` for the SQLite FTS table check
+_sqlite_fts_available = {}
+
+
+def _search_backend(connection):
+    """Return the name of the search backend to use for `connection`."""
+    if connection.vendor == "postgresql":
+        return "postgresql"
+    if connection.vendor == "sqlite":
+        if connection.alias not in _sqlite_fts_available:
+            _sqlite_fts_available[connection.alias] = (
+                FTS_TABLE in connection.introspection.table_names()
+            )
+        if _sqlite_fts_available[connection.alias]:
+            return "sqlite"
+    return "fallback"
+
+
+def _fts5_query(query):
+    """Turn free text into a safe FTS5 query.
+
+    Each word is quoted so FTS5 operators in user input are treated as
+    plain text, and given a prefix match so `shir` still finds `shirt`.
+    All words must match, as with the previous `icontains` search.
+    """
+    terms = re.findall(r"\w+", query)
+    return " ".join('"{}"*'.format(term) for term in terms)
+
+
+def search_products(queryset, query):
+    """Filter `queryset` to products matching `query`.
+
+    Matching products are annotated with `search_rank`, where a higher
+    value means a more relevant result.
+
+    Arguments:
+        queryset -- the `Product` queryset to filter
+        query -- the search term entered by the customer
+
+    Returns:
+        the filtered and annotated queryset
+    """
+    connection = connections[queryset.db]
+    backend = _search_backend(connection)
+
+    if backend == "postgresql":
+        tsquery = "websearch_to_tsquery('english', %s)"
+        return queryset.annotate(
+            search_match=RawSQL(
+                f'"products_product"."search_vector" @@ {tsquery}',
+                (query,),
+                output_field=BooleanField(),
+            ),
+            search_rank=RawSQL(
+                f'ts_rank("products_product"."search_vector", {tsquery})',
+                (query,),
+                output_field=FloatField(),
+            ),
+        ).filter(search_match=True)
+
+    if backend == "sqlite":
+        match = _fts5_query(query)
+        if not match:
+            # Nothing to search for, but callers still order by rank
+            return queryset.none().annotate(
+                search_rank=Value(0.0, output_field=FloatField())
+            )
+        # bm25() is lower for better matches; negate so higher is better
+        # Column weights: name 10, description 1
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                (match,),
+            )
+        ).annotate(
+            search_rank=RawSQL(
+                f"SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} "
+                f"WHERE {FTS_TABLE} MATCH %s "
+                f'AND rowid = "products_product"."id"',
+                (match,),
+                output_field=FloatField(),
+            )
+        )
+
+    return queryset.filter(
+        Q(name__icontains=query) | Q(description__icontains=query)
+    ).annotate(search_rank=Value(0.0, output_field=FloatField()))
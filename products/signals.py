@@ -0,0 +1,29 @@
+"""These signals invalidate cached product listings whenever the
+catalog changes.
+
+The module's `apps.py` must be updated to know about these signals.
+"""
+
+# Send these signals after ('post') the action
+from django.db.models.signals import post_delete, post_save
+
+# To receive signals
+from django.dispatch import receiver
+
+from .cache import bump_catalog_version
+
+# The models we are listening to signals from
+from .models import Category, Product
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_listings(sender, **kwargs):
+    """Bump the catalog version when a product or category changes.
+
+    Arguments:
+        sender -- the model class that sent the signal
+    """
+    bump_catalog_version()
@@ -1,3 +1,371 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .cache import get_catalog_version
+from .models import Category, Product
+from .pagination import encode_cursor, paginate_keyset, paginate_offset
+from .views import SORT_KEYS
+
+
+class CatalogTestCase(TestCase):
+    """Creates a small catalog with tied prices, missing ratings and a
+    product without a category, to exercise every sort key.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.shirts = Category.objects.create(
+            name="shirts", friendly_name="Shirts"
+        )
+        self.jeans = Category.objects.create(
+            name="jeans", friendly_name="Jeans"
+        )
+        prices = ["10.00", "5.00", "10.00", "20.00", "5.00", "15.00", "10.00"]
+        ratings = ["4.50", None, "3.00", None, "4.50", "1.00", "2.00"]
+        categories = [self.shirts, self.jeans, None, self.shirts]
+        names = [
+            "beta",
+            "Alpha",
+            "delta",
+            "Charlie",
+            "echo",
+            "Golf",
+            "foxtrot",
+        ]
+        self.products = [
+            Product.objects.create(
+                name=f"{name} item",
+                description="Something to wear",
+                price=Decimal(price),
+                rating=Decimal(rating) if rating else None,
+                category=categories[n % len(categories)],
+            )
+            for n, (name, price, rating) in enumerate(
+                zip(names, prices, ratings)
+            )
+        ]
+
+    def expected_order(self, sort, descending=False):
+        """Product ids in the order the listing should show them, with
+        missing values first ascending and last descending.
+        """
+
+        def value(product):
+            if sort == "name":
+                return product.name.lower()
+            if sort == "category":
+                return product.category.name if product.category else None
+            return getattr(product, sort)
+
+        # Stands in for missing values, which sort before all others
+        placeholder = "" if sort in ("name", "category") else 0
+
+        def key(product):
+            sort_value = value(product)
+            if sort_value is None:
+                return (False, placeholder, product.pk)
+            return (True, sort_value, product.pk)
+
+        products = sorted(self.products, key=key, reverse=descending)
+        return [product.pk for product in products]
+
+
+class KeysetPaginationTests(CatalogTestCase):
+    def walk_forward(self, ordering, page_size=3):
+        pages = []
+        page = paginate_keyset(
+            Product.objects.all(), ordering, None, page_size
+        )
+        pages.append(page)
+        while page.has_next:
+            page = paginate_keyset(
+                Product.objects.all(), ordering, page.next_cursor, page_size
+            )
+            pages.append(page)
+        return pages
+
+    def ids(self, page):
+        return [product.pk for product in page]
+
+    def test_every_product_appears_once_in_order(self):
+        for field, sort in (("price", "price"), ("rating", "rating")):
+            for descending in (False, True):
+                ordering = [f"-{field}" if descending else field]
+                with self.subTest(ordering=ordering):
+                    pages = self.walk_forward(ordering)
+                    seen = [pk for page in pages for pk in self.ids(page)]
+                    self.assertEqual(
+                        seen, self.expected_order(sort, descending)
+                    )
+                    self.assertTrue(all(len(page) <= 3 for page in pages))
+
+    def test_missing_values_come_first_ascending_last_descending(self):
+        missing = {p.pk for p in self.products if p.rating is None}
+        ascending = self.ids(
+            paginate_keyset(Product.objects.all(), ["rating"])
+        )
+        descending = self.ids(
+            paginate_keyset(Product.objects.all(), ["-rating"])
+        )
+
+        self.assertEqual(set(ascending[: len(missing)]), missing)
+        self.assertEqual(set(descending[-len(missing) :]), missing)
+
+    def test_previous_pages_match_the_forward_pages(self):
+        pages = self.walk_forward(["price"])
+        self.assertEqual(len(pages), 3)
+
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = paginate_keyset(
+                Product.objects.all(), ["price"], page.previous_cursor, 3
+            )
+            self.assertEqual(self.ids(page), self.ids(expected))
+        # Back at the start there is no previous page
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+
+    def test_reaching_the_start_shows_a_full_first_page(self):
+        first, second, _ = self.walk_forward(["price"])
+        # The first page now has a row fewer than a page
+        Product.objects.filter(pk=self.ids(first)[0]).delete()
+
+        page = paginate_keyset(
+            Product.objects.all(), ["price"], second.previous_cursor, 3
+        )
+
+        self.assertEqual(self.ids(page), self.expected_order("price")[1:4])
+        self.assertFalse(page.has_previous)
+
+    def test_cursor_for_another_ordering_starts_over(self):
+        first = paginate_keyset(Product.objects.all(), ["price"], None, 3)
+
+        page = paginate_keyset(
+            Product.objects.all(), ["-price"], first.next_cursor, 3
+        )
+
+        self.assertEqual(
+            self.ids(page), self.expected_order("price", descending=True)[:3]
+        )
+        self.assertFalse(page.has_previous)
+
+    def test_bad_cursors_start_over(self):
+        first = paginate_keyset(Product.objects.all(), ["price"], None, 3)
+        for cursor in ("not-a-cursor", first.next_cursor[:-2] + "xx"):
+            with self.subTest(cursor=cursor):
+                page = paginate_keyset(
+                    Product.objects.all(), ["price"], cursor, 3
+                )
+                self.assertEqual(self.ids(page), self.ids(first))
+
+    def test_offset_pages_walk_forward_and_back(self):
+        queryset = Product.objects.order_by("pk")
+        first = paginate_offset(queryset, None, 3)
+        second = paginate_offset(queryset, first.next_cursor, 3)
+        third = paginate_offset(queryset, second.next_cursor, 3)
+
+        self.assertEqual(
+            [p.pk for page in (first, second, third) for p in page],
+            sorted(p.pk for p in self.products),
+        )
+        self.assertFalse(third.has_next)
+        self.assertFalse(first.has_previous)
+        back = paginate_offset(queryset, third.previous_cursor, 3)
+        self.assertEqual(self.ids(back), self.ids(second))
+
+        # A negative offset can't be signed by a customer, but is clamped
+        page = paginate_offset(queryset, encode_cursor({"offset": -5}), 3)
+        self.assertEqual(self.ids(page), self.ids(first))
+
+
+class ProductListingTests(CatalogTestCase):
+    def get_ids(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, [
+            product.pk for product in response.context["products"]
+        ]
+
+    def walk(self, params):
+        """Follow the next links, then the previous links back, returning
+        the ids seen each way.
+        """
+        response, ids = self.get_ids(reverse("products"), params)
+        pages = [ids]
+        while response.context["next_page_url"]:
+            response, ids = self.get_ids(response.context["next_page_url"])
+            pages.append(ids)
+        back = [ids]
+        while response.context["previous_page_url"]:
+            response, ids = self.get_ids(response.context["previous_page_url"])
+            back.append(ids)
+        return pages, back[::-1]
+
+    def test_every_sort_walks_forward_and_back(self):
+        for sort in SORT_KEYS:
+            for direction in ("asc", "desc"):
+                with self.subTest(sort=sort, direction=direction):
+                    pages, back = self.walk(
+                        {"sort": sort, "direction": direction, "page_size": 3}
+                    )
+                    seen = [pk for page in pages for pk in page]
+                    self.assertEqual(
+                        seen, self.expected_order(sort, direction == "desc")
+                    )
+                    self.assertEqual(back, pages)
+
+    @override_settings(PRODUCTS_PAGE_SIZE=4, PRODUCTS_MAX_PAGE_SIZE=5)
+    def test_page_size_is_capped(self):
+        for page_size, expected in (("100", 5), ("0", 1), ("x", 4), ("2", 2)):
+            with self.subTest(page_size=page_size):
+                _, ids = self.get_ids(
+                    reverse("products"), {"page_size": page_size}
+                )
+                self.assertEqual(len(ids), expected)
+
+    def test_category_filter(self):
+        response, ids = self.get_ids(
+            reverse("products"), {"category": "shirts"}
+        )
+
+        self.assertEqual(
+            set(ids),
+            {p.pk for p in self.products if p.category == self.shirts},
+        )
+        self.assertEqual(response.context["total_products"], len(ids))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.shirts = Category.objects.create(name="shirts")
+        self.in_description = Product.objects.create(
+            name="Plain top",
+            description="Goes with any shirt",
+            price=Decimal("10.00"),
+            category=self.shirts,
+        )
+        self.in_name = Product.objects.create(
+            name="Test shirt", description="A shirt", price=Decimal("10.00")
+        )
+        Product.objects.create(
+            name="Jeans", description="Blue denim", price=Decimal("10.00")
+        )
+
+    def search(self, **params):
+        response = self.client.get(reverse("products"), params)
+        self.assertEqual(response.status_code, 200)
+        return [product.pk for product in response.context["products"]]
+
+    def test_search_finds_products(self):
+        self.assertEqual(len(self.search(q="shirt")), 2)
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(
+            self.search(q="shirt"), [self.in_name.pk, self.in_description.pk]
+        )
+
+    def test_words_are_prefix_matched(self):
+        self.assertEqual(
+            self.search(q="shir"), [self.in_name.pk, self.in_description.pk]
+        )
+
+    def test_search_within_a_category(self):
+        self.assertEqual(
+            self.search(q="shirt", category="shirts"),
+            [self.in_description.pk],
+        )
+
+    def test_search_pages_by_relevance(self):
+        first = self.client.get(
+            reverse("products"), {"q": "shirt", "page_size": 1}
+        )
+        second = self.client.get(first.context["next_page_url"])
+
+        self.assertEqual(
+            [p.pk for p in first.context["products"]], [self.in_name.pk]
+        )
+        self.assertEqual(
+            [p.pk for p in second.context["products"]],
+            [self.in_description.pk],
+        )
+        self.assertIsNone(second.context["next_page_url"])
+
+    def test_search_without_words_finds_nothing(self):
+        for query in ("-", "*", '"'):
+            with self.subTest(query=query):
+                self.assertEqual(self.search(q=query), [])
+
+
+class ListingCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.category = Category.objects.create(name="shirts")
+        self.product = Product.objects.create(
+            name="Test shirt",
+            description="A shirt",
+            price=Decimal("10.00"),
+            category=self.category,
+        )
+
+    def get_listing(self, **params):
+        response = self.client.get(reverse("products"), params)
+        return (
+            [product.pk for product in response.context["products"]],
+            response.context["total_products"],
+        )
+
+    def test_repeat_listing_is_served_from_the_cache(self):
+        self.get_listing()
+        # A cached page costs only the query loading its products
+        with self.assertNumQueries(1):
+            self.get_listing()
+
+    def test_product_changes_bump_the_version(self):
+        self.assertEqual(self.get_listing(), ([self.product.pk], 1))
+
+        version = get_catalog_version()
+        other = Product.objects.create(
+            name="Other shirt", description="A shirt", price=Decimal("5.00")
+        )
+        self.assertGreater(get_catalog_version(), version)
+        self.assertEqual(self.get_listing(), ([self.product.pk, other.pk], 2))
+
+        version = get_catalog_version()
+        other.delete()
+        self.assertGreater(get_catalog_version(), version)
+        self.assertEqual(self.get_listing(), ([self.product.pk], 1))
+
+    def test_saving_a_product_changes_its_sort_position(self):
+        other = Product.objects.create(
+            name="Other shirt", description="A shirt", price=Decimal("5.00")
+        )
+        self.assertEqual(
+            self.get_listing(sort="price")[0], [other.pk, self.product.pk]
+        )
+
+        other.price = Decimal("50.00")
+        other.save()
+        self.assertEqual(
+            self.get_listing(sort="price")[0], [self.product.pk, other.pk]
+        )
+
+    def test_category_changes_bump_the_version(self):
+        self.assertEqual(
+            self.get_listing(category="shirts"), ([self.product.pk], 1)
+        )
+
+        version = get_catalog_version()
+        self.category.name = "tops"
+        self.category.save()
+        self.assertGreater(get_catalog_version(), version)
+        self.assertEqual(self.get_listing(category="shirts"), ([], 0))
+        self.assertEqual(
+            self.get_listing(category="tops"), ([self.product.pk], 1)
+        )
@@ -1,10 +1,25 @@
+from django.conf import settings
 from django.contrib import messages
-from django.db.models import Q
 from django.db.models.functions import Lower
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 
+from .cache import get_or_set_listing, normalize_params
 from .models import Category, Product
+from .pagination import Page, paginate_keyset, paginate_offset
+from .search import search_products
+
+# Sort options offered by the sort selector in `products.html`
+SORT_KEYS = ("price", "rating", "name", "category")
+
+
+def _get_page_size(request):
+    """Page size from `?page_size=`, capped at the configured maximum."""
+    try:
+        page_size = int(request.GET.get("page_size", ""))
+    except ValueError:
+        return settings.PRODUCTS_PAGE_SIZE
+    return min(max(page_size, 1), settings.PRODUCTS_MAX_PAGE_SIZE)
 
 
 # Create your views here.
@@ -20,6 +35,9 @@ def all_products(request):
     # i.e., initialize for instances where no sorting request exists
     sort = None
     direction = None
+    # Sort keys for pagination. Product id unless sorting or searching
+    ordering = ["pk"]
+    category_names = None
 
     # Access URL parameters from form get
     if request.GET:
@@ -34,16 +52,9 @@ def all_products(request):
                 messages.error(request, "You didn't enter any search criteria")
                 return redirect(reverse("products"))
 
-            # Use Q object for complex lookup
-            # https://docs.djangoproject.com/en/3.2/topics/db/queries/#complex-lookups-with-q-objects
-
-            # Get `Products` item whose query matches name or description
-            # Use OR statement and specify case insensitivity
-            queries = Q(name__icontains=query) | Q(
-                description__icontains=query
-            )
-            # Perform the actual filtering with the Q objects
-            products = products.filter(queries)
+            # Full-text search over name and description, ranked by
+            # relevance. See `search.py` for the per-database backends
+            products = search_products(products, query)
 
         # If `category` is in the URL from the GET request from nav links
         if "category" in request.GET:
@@ -56,6 +67,7 @@ def all_products(request):
             # Get the csv list of categories from the href and split commas
             # dict lookup with square brackets, not a method call
             categories = request.GET["category"].split(",")
+            category_names = categories
             # Use these categories to filter the products for the context
             # https://docs.djangoproject.com/en/3.2/topics/db/queries/#lookups-that-span-relationships
             # https://docs.djangoproject.com/en/3.2/ref/models/querysets/#in
@@ -64,7 +76,7 @@ def all_products(request):
             categories = Category.objects.filter(name__in=categories)
 
         # Handle sort queries found in the URL
-        if "sort" in request.GET:
+        if request.GET.get("sort") in SORT_KEYS:
             sortkey = request.GET["sort"]
             # Get sort from `sortkey` from default `None`
             sort = sortkey
@@ -80,7 +92,7 @@ def all_products(request):
 
             # Drill down to sort by name, not id
             if sortkey == "category":
-                sortkey == "category__name"
+                sortkey = "category__name"
 
             if "direction" in request.GET:
                 direction = request.GET["direction"]
@@ -88,8 +100,63 @@ def all_products(request):
                     # Use `-` to reverse sort direction
                     sortkey = f"-{sortkey}"
 
-            # Return processed queryset
-            products = products.order_by(sortkey)
+            # Used to order and paginate the processed queryset
+            ordering = [sortkey]
+
+        # Most relevant search results first unless a sort was requested
+        elif query:
+            ordering = None
+
+    # Only load and render a single page of products
+    # The `cursor` param comes from the next/previous page links
+    cursor = request.GET.get("cursor")
+    page_size = _get_page_size(request)
+    # Category is shown on every product card
+    products = products.select_related("category")
+
+    def get_page():
+        if ordering:
+            page = paginate_keyset(products, ordering, cursor, page_size)
+        else:
+            # Relevance is a computed float, so page by offset instead
+            page = paginate_offset(
+                products.order_by("-search_rank", "pk"), cursor, page_size
+            )
+        return {
+            "ids": [product.pk for product in page],
+            "next": page.next_cursor,
+            "previous": page.previous_cursor,
+        }
+
+    # The ordered ids of each page are cached until the catalog changes,
+    # so repeat visits skip the search, filter and sort entirely
+    listing = normalize_params(query, category_names, sort, direction)
+    cached_page = get_or_set_listing(
+        "page", listing, get_page, cursor=cursor, page_size=page_size
+    )
+    products_by_id = Product.objects.select_related("category").in_bulk(
+        cached_page["ids"]
+    )
+    page = Page(
+        [
+            products_by_id[pk]
+            for pk in cached_page["ids"]
+            if pk in products_by_id
+        ],
+        cached_page["next"],
+        cached_page["previous"],
+    )
+
+    # Page links keep the current search, filter and sort params
+    page_urls = {}
+    for name, page_cursor in (
+        ("next_page_url", page.next_cursor),
+        ("previous_page_url", page.previous_cursor),
+    ):
+        if page_cursor:
+            params = request.GET.copy()
+            params["cursor"] = page_cursor
+            page_urls[name] = f"{reverse('products')}?{params.urlencode()}"
 
     # Return sorting methodology for use in the template
     # Returns `None_None` when no sorting used
@@ -97,7 +164,13 @@ def all_products(request):
 
     # The `query` must be provided to the context
     context = {
-        "products": products,
+        "products": page,
+        # Only the search and categories change the number of products
+        "total_products": get_or_set_listing(
+            "count", normalize_params(query, category_names), products.count
+        ),
+        "next_page_url": page_urls.get("next_page_url"),
+        "previous_page_url": page_urls.get("previous_page_url"),
         "search_term": query,
         "current_categories": categories,
         "current_sorting": current_sorting,
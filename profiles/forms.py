@@ -1,6 +1,7 @@
 from django import forms
 
 from .models import UserProfile
+from .widgets import CountrySelect, country_choices
 
 
 class UserProfileForm(forms.ModelForm):
@@ -8,6 +9,8 @@ class UserProfileForm(forms.ModelForm):
         model = UserProfile
         # Render all fields except 'user', which shouldn't change
         exclude = ("user",)
+        # Cached country select, see `widgets.py`
+        widgets = {"default_country": CountrySelect}
 
     # Override default form setup
     def __init__(self, *args, **kwargs):
@@ -16,6 +19,9 @@ class UserProfileForm(forms.ModelForm):
         labels and set autofocus on first field
         """
         super().__init__(*args, **kwargs)
+        self.fields["default_country"].choices = country_choices(
+            UserProfile._meta.get_field("default_country").blank_label
+        )
         # 'default_' matches model
         placeholders = {
             "default_phone_number": "Phone Number",
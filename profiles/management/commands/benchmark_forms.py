@@ -0,0 +1,80 @@
+"""Time rendering the checkout and profile forms.
+
+    python manage.py benchmark_forms
+    python manage.py benchmark_forms --repeat 10
+
+Each form is rendered with crispy-forms as its page does, twice over:
+with the country caches from `profiles/widgets.py` emptied before every
+render, which costs what every render did before they were added, and
+with them warm, as on every view after the first. No database access is
+needed.
+"""
+
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.template import engines
+
+from checkout.forms import OrderForm
+from profiles.forms import UserProfileForm
+from profiles.widgets import clear_country_caches
+
+# The fields of the order form, in the order `checkout.html` renders them
+ORDER_FIELDS = (
+    "full_name",
+    "email",
+    "phone_number",
+    "street_address1",
+    "street_address2",
+    "town_or_city",
+    "county",
+    "postcode",
+    "country",
+)
+
+FORMS = {
+    "checkout": (
+        OrderForm,
+        "".join(
+            f"{{{{ form.{name}|as_crispy_field }}}}" for name in ORDER_FIELDS
+        ),
+    ),
+    "profile": (UserProfileForm, "{{ form|crispy }}"),
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark rendering the checkout and profile forms."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Timing runs per form; the fastest is reported.",
+        )
+
+    def handle(self, *args, **options):
+        for name, (form_class, source) in FORMS.items():
+            template = engines["django"].from_string(source)
+
+            def render():
+                return template.render({"form": form_class()})
+
+            def render_cold():
+                clear_country_caches()
+                return render()
+
+            results = []
+            for label, function in (("cold", render_cold), ("warm", render)):
+                timer = timeit.Timer(function)
+                # Enough calls per run to take at least 0.2s
+                number, _ = timer.autorange()
+                best = min(timer.repeat(options["repeat"], number)) / number
+                results.append(best)
+                self.stdout.write(
+                    f"{name:>8} {label}: {best * 1e3:8.2f} ms per render"
+                )
+            self.stdout.write(
+                f"{name:>8} speedup: {results[0] / results[1]:8.1f}x"
+            )
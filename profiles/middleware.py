@@ -0,0 +1,43 @@
+"""Makes the logged in user's profile available as `request.user_profile`.
+
+The profile is looked up, along with its user, the first time it's used
+in a request, and reused for the rest of it, in the same way
+`AuthenticationMiddleware` provides `request.user`. It's `None` for
+anonymous users and users without a profile, so check it before use,
+e.g. `if request.user_profile:`.
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from .models import UserProfile
+
+
+def get_user_profile(request):
+    """Return the request user's profile, or `None`, querying at most
+    once per request.
+    """
+    if not hasattr(request, "_cached_user_profile"):
+        profile = None
+        if request.user.is_authenticated:
+            profile = (
+                UserProfile.objects.select_related("user")
+                .filter(user=request.user)
+                .first()
+            )
+        request._cached_user_profile = profile
+    return request._cached_user_profile
+
+
+class UserProfileMiddleware:
+    """Set a lazy `request.user_profile`. Must come after
+    `AuthenticationMiddleware`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user_profile = SimpleLazyObject(
+            lambda: get_user_profile(request)
+        )
+        return self.get_response(request)
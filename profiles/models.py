@@ -30,16 +30,53 @@ class UserProfile(models.Model):
         blank_label="Country", null=True, blank=True
     )
 
+    # Order fields saved as the profile's defaults, by profile field
+    ORDER_DEFAULT_FIELDS = {
+        "default_phone_number": "phone_number",
+        "default_country": "country",
+        "default_postcode": "postcode",
+        "default_town_or_city": "town_or_city",
+        "default_street_address1": "street_address1",
+        "default_street_address2": "street_address2",
+        "default_county": "county",
+    }
+
     def __str__(self):
         return self.user.username
 
+    def update_defaults_from_order(self, order):
+        """Save an order's delivery details as the profile's defaults.
+
+        Only the fields that changed are written, and nothing at all if
+        they're already the same.
+
+        Returns:
+            whether the profile was saved
+        """
+        changed = []
+        for profile_field, order_field in self.ORDER_DEFAULT_FIELDS.items():
+            value = getattr(order, order_field)
+            if getattr(self, profile_field) != value:
+                setattr(self, profile_field, value)
+                changed.append(profile_field)
+        if changed:
+            self.save(update_fields=changed)
+        return bool(changed)
+
 
 @receiver(post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
+def create_or_update_user_profile(
+    sender, instance, created, update_fields=None, **kwargs
+):
     """
-    Create or update the user profile
+    Create the user profile for new users
+
+    Nothing on the profile depends on the user, so there is nothing to
+    update. Saves of just some fields, like `last_login` on every login,
+    are skipped without touching the profile table. Any other save of an
+    existing user creates their profile if they don't have one yet.
     """
     if created:
         UserProfile.objects.create(user=instance)
-    # Existing users: just save the profile
-    instance.userprofile.save()
+    elif not update_fields:
+        UserProfile.objects.get_or_create(user=instance)
@@ -1,3 +1,247 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone, translation
+from django_countries.widgets import LazySelect
+
+from checkout.forms import OrderForm
+from checkout.models import Order, OrderLineItem
+from products.models import Product
+
+from .forms import UserProfileForm
+from .middleware import UserProfileMiddleware
+from .models import UserProfile
+from .widgets import clear_country_caches
+
+
+@override_settings(PROFILE_ORDERS_PAGE_SIZE=4)
+class OrderHistoryTests(TestCase):
+    # Session, user, profile, a page of orders, and their line items
+    QUERY_BUDGET = 5
+
+    def setUp(self):
+        self.user = User.objects.create_user("customer", password="password")
+        self.profile = self.user.userprofile
+        self.client.force_login(self.user)
+        self.products = [
+            Product.objects.create(
+                name=f"Test shirt {n}",
+                description="A shirt",
+                price=Decimal("10.00"),
+            )
+            for n in range(2)
+        ]
+
+    def create_orders(self, count):
+        """Create orders with two line items each, some placed at the
+        same time, newest last.
+        """
+        now = timezone.now()
+        for n in range(count):
+            order = Order.objects.create(
+                user_profile=self.profile,
+                full_name="A Customer",
+                email="customer@example.com",
+                phone_number="0123456789",
+                country="GB",
+                town_or_city="Leeds",
+                street_address1="1 Test Street",
+            )
+            Order.objects.filter(pk=order.pk).update(
+                date=now - timedelta(hours=(count - n) // 2)
+            )
+            for product in self.products:
+                OrderLineItem.objects.create(
+                    order=order, product=product, quantity=1
+                )
+
+    def test_query_count_does_not_grow_with_orders(self):
+        for count in (1, 10):
+            Order.objects.all().delete()
+            self.create_orders(count)
+            with self.assertNumQueries(self.QUERY_BUDGET):
+                self.client.get(reverse("profile"))
+
+    def test_pages_list_every_order_once_newest_first(self):
+        self.create_orders(10)
+        expected = list(
+            Order.objects.order_by("-date", "-pk").values_list(
+                "order_number", flat=True
+            )
+        )
+
+        seen = []
+        url = reverse("profile")
+        while url:
+            with self.assertNumQueries(self.QUERY_BUDGET):
+                response = self.client.get(url)
+            page = response.context["orders"]
+            self.assertLessEqual(len(page), 4)
+            seen += [order.order_number for order in page]
+            url = response.context.get("next_orders_url")
+
+        self.assertEqual(seen, expected)
+
+    def test_previous_page_link(self):
+        self.create_orders(10)
+        first = self.client.get(reverse("profile"))
+        second = self.client.get(first.context["next_orders_url"])
+        previous = self.client.get(second.context["previous_orders_url"])
+
+        self.assertEqual(
+            [order.pk for order in previous.context["orders"]],
+            [order.pk for order in first.context["orders"]],
+        )
+
+    def test_updating_the_profile_does_not_load_orders(self):
+        self.create_orders(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("profile"), {"default_postcode": "LS1 1AA"}
+            )
+
+        self.assertRedirects(
+            response, reverse("profile"), fetch_redirect_response=False
+        )
+        self.assertFalse([q for q in queries if "checkout_order" in q["sql"]])
+
+
+class UserProfileSignalTests(TestCase):
+    def profile_queries(self, queries):
+        return [q for q in queries if "profiles_userprofile" in q["sql"]]
+
+    def test_new_users_get_a_profile(self):
+        user = User.objects.create_user("customer", password="password")
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+
+    def test_logging_in_does_not_touch_the_profile(self):
+        User.objects.create_user("customer", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(
+                self.client.login(username="customer", password="password")
+            )
+        self.assertEqual(self.profile_queries(queries), [])
+
+    def test_saving_a_user_does_not_update_the_profile(self):
+        user = User.objects.create_user("customer", password="password")
+        user.first_name = "A"
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertFalse(
+            [
+                q
+                for q in self.profile_queries(queries)
+                if q["sql"].startswith(("INSERT", "UPDATE"))
+            ]
+        )
+
+    def test_saving_a_user_without_a_profile_creates_one(self):
+        user = User.objects.create_user("customer", password="password")
+        UserProfile.objects.filter(user=user).delete()
+        user = User.objects.get(pk=user.pk)
+
+        user.save()
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+
+
+class UserProfileMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("customer", password="password")
+
+    def process(self, user):
+        request = RequestFactory().get("/")
+        request.user = user
+        UserProfileMiddleware(lambda request: None)(request)
+        return request
+
+    def test_profile_is_loaded_once_with_its_user(self):
+        request = self.process(User.objects.get(pk=self.user.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual(request.user_profile.user, self.user)
+            self.assertEqual(request.user_profile.pk, self.user.userprofile.pk)
+
+    def test_anonymous_users_have_no_profile(self):
+        request = self.process(AnonymousUser())
+        with self.assertNumQueries(0):
+            self.assertFalse(request.user_profile)
+
+    def test_checkout_page_queries_the_profile_once(self):
+        self.client.force_login(self.user)
+        product = Product.objects.create(
+            name="Test shirt",
+            description="A shirt",
+            price=Decimal("10.00"),
+            image="test-shirt.jpg",
+        )
+        self.client.post(
+            reverse("add_to_bag", args=[product.pk]),
+            {"quantity": 1, "redirect_url": "/"},
+        )
+        intent = {"id": "pi_test", "client_secret": "pi_test_secret_test"}
+        with mock.patch(
+            "checkout.views.get_payment_intent", return_value=intent
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("checkout"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len([q for q in queries if "profiles_userprofile" in q["sql"]]),
+            1,
+        )
+
+
+class CountrySelectTests(TestCase):
+    def setUp(self):
+        clear_country_caches()
+        self.addCleanup(clear_country_caches)
+
+    def test_renders_the_same_as_the_stock_select(self):
+        form = OrderForm(initial={"country": "GB"})
+        stock = Order._meta.get_field("country").formfield()
+        stock.widget.attrs = form.fields["country"].widget.attrs
+
+        self.assertHTMLEqual(
+            str(form["country"]),
+            stock.widget.render(
+                "country", "GB", {"id": "id_country", "required": True}
+            ),
+        )
+
+    def render_profile_country(self, country):
+        form = UserProfileForm(initial={"default_country": country})
+        return str(form["default_country"])
+
+    def test_markup_is_reused_for_the_same_value(self):
+        with mock.patch.object(
+            LazySelect, "render", return_value="<select></select>"
+        ) as render:
+            self.render_profile_country("GB")
+            self.render_profile_country("GB")
+            self.assertEqual(render.call_count, 1)
+
+            self.render_profile_country("FR")
+            str(OrderForm(initial={"country": "GB"})["country"])
+            self.assertEqual(render.call_count, 3)
+
+    def test_markup_is_cached_per_language(self):
+        with mock.patch.object(
+            LazySelect, "render", return_value="<select></select>"
+        ) as render:
+            str(OrderForm()["country"])
+            with translation.override("fr"):
+                str(OrderForm()["country"])
+            self.assertEqual(render.call_count, 2)
+
+    def test_choices_are_still_validated(self):
+        self.assertTrue(UserProfileForm({"default_country": "GB"}).is_valid())
+        self.assertIn(
+            "default_country",
+            UserProfileForm({"default_country": "XX"}).errors,
+        )
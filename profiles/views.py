@@ -1,16 +1,61 @@
+from django.conf import settings
 from django.contrib import messages
-from django.shortcuts import get_object_or_404, render
+from django.db.models import Prefetch
+from django.http import Http404
+from django.shortcuts import redirect, render, reverse
+from django.utils.http import urlencode
 
 # For order history
-from checkout.models import Order
+from checkout.cache import render_order_detail
+from checkout.models import OrderLineItem
+from checkout.services import get_order_detail
+from products.pagination import paginate_keyset
 
 from .forms import UserProfileForm
-from .models import UserProfile
+
+
+def get_order_history(profile, cursor=None):
+    """Return one `Page` of a profile's orders, newest first.
+
+    Only the columns the order history table shows are loaded, and the
+    line items and their products for the whole page are fetched with
+    one more query.
+
+    Arguments:
+        profile -- the `UserProfile` whose orders to list
+        cursor -- the `?cursor=` param from a next/previous page link
+    """
+    lineitems = (
+        OrderLineItem.objects.select_related("product")
+        .only(
+            "order",
+            "product_size",
+            "quantity",
+            "product__name",
+            "product__has_sizes",
+        )
+        .order_by("pk")
+    )
+    orders = (
+        # The related manager sets `user_profile` on each order, so its
+        # column is loaded too
+        profile.orders.only(
+            "user_profile", "order_number", "date", "grand_total"
+        )
+        # Line items are prefetched for the page only, after slicing
+        .prefetch_related(Prefetch("lineitems", queryset=lineitems))
+    )
+    return paginate_keyset(
+        orders, ["-date"], cursor, settings.PROFILE_ORDERS_PAGE_SIZE
+    )
 
 
 def profile(request):
     """Display the user's profile."""
-    profile = get_object_or_404(UserProfile, user=request.user)
+    # Looked up once per request by `UserProfileMiddleware`
+    profile = request.user_profile
+    if not profile:
+        raise Http404("No profile found.")
 
     # Populate form with current user's profile information
     form = UserProfileForm(instance=profile)
@@ -20,15 +65,28 @@ def profile(request):
         if form.is_valid():
             form.save()
             messages.success(request, "Profile updated successfully")
+            # Redirect so a refresh doesn't resubmit the form, and the
+            # order history is only loaded by the GET
+            return redirect(reverse("profile"))
 
-    # Use related name on the order model to get order history
-    orders = profile.orders.all()
+    # Use related name on the order model to get order history, one page
+    # at a time; the `cursor` param comes from the next/previous links
+    orders = get_order_history(profile, request.GET.get("cursor"))
+    page_urls = {
+        name: f"{reverse('profile')}?{urlencode({'cursor': page_cursor})}"
+        for name, page_cursor in (
+            ("next_orders_url", orders.next_cursor),
+            ("previous_orders_url", orders.previous_cursor),
+        )
+        if page_cursor
+    }
 
     template = "profiles/profile.html"
     context = {
         # "profile": profile,
         "form": form,
         "orders": orders,
+        **page_urls,
         # For profile update success message toasts
         "on_profile_page": True,
     }
@@ -37,7 +95,7 @@ def profile(request):
 
 
 def order_history(request, order_number):
-    order = get_object_or_404(Order, order_number=order_number)
+    order = get_order_detail(order_number)
 
     messages.info(
         request,
@@ -51,6 +109,7 @@ def order_history(request, order_number):
     template = "checkout/checkout_success.html"
     context = {
         "order": order,
+        "order_detail": render_order_detail(order),
         # If user got to the checkout_success template from the order_history view
         "from_profile": True,
     }
@@ -0,0 +1,85 @@
+"""Cached country choices and select widget for the order and profile
+forms.
+
+Building django-countries' list of about 250 translated and sorted
+choices, and rendering an `<option>` for each of them, takes tens of
+milliseconds, and the checkout and profile pages did both on every view.
+Neither depends on anything but the active language, the blank label
+and, for the markup, the selected value and the widget's attrs. So:
+
+- `country_choices()` builds the choices once per language and blank
+  label
+- `CountrySelect` renders the whole `<select>` once per language, field
+  name, blank label, selected value and attrs, and reuses the markup
+
+Both caches are per process and bounded, and don't expire, as the
+country list only changes with a deploy.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.utils.translation import get_language
+from django_countries import countries
+from django_countries.widgets import LazySelect
+
+# Most rendered selects kept, e.g. for every language, form and country
+RENDER_CACHE_SIZE = 512
+
+_choices = {}
+_rendered = OrderedDict()
+_lock = threading.Lock()
+
+
+def country_choices(blank_label):
+    """Return the country choices for the active language, with a blank
+    choice first, as a `CountryField` form field would have them.
+
+    Arguments:
+        blank_label -- the label of the blank choice, e.g. `"Country *"`
+    """
+    key = (get_language(), str(blank_label))
+    choices = _choices.get(key)
+    if choices is None:
+        # A tuple, as the same choices are shared by every form
+        choices = (("", str(blank_label)), *countries)
+        _choices[key] = choices
+    return choices
+
+
+def clear_country_caches():
+    """Empty the choice and markup caches, e.g. for benchmarks."""
+    with _lock:
+        _choices.clear()
+        _rendered.clear()
+
+
+class CountrySelect(LazySelect):
+    """A country select that reuses its rendered markup.
+
+    Give its field `country_choices()`; the blank choice is part of the
+    cache key, and the rest of the choices are assumed to be the
+    countries in the active language.
+    """
+
+    def render(self, name, value, attrs=None, renderer=None):
+        key = (
+            get_language(),
+            name,
+            self.choices[0] if self.choices else None,
+            tuple(self.format_value(value)),
+            tuple(sorted(self.build_attrs(self.attrs, attrs).items())),
+        )
+        with _lock:
+            html = _rendered.get(key)
+            if html is not None:
+                _rendered.move_to_end(key)
+                return html
+
+        html = super().render(name, value, attrs, renderer)
+        with _lock:
+            _rendered[key] = html
+            if len(_rendered) > RENDER_CACHE_SIZE:
+                # Drop the least recently used
+                _rendered.popitem(last=False)
+        return html